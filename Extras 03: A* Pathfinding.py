@@ -1,4 +1,5 @@
 import tcod
+import numpy as np
 import math
 import textwrap
 import shelve
@@ -160,15 +161,65 @@ class Rect:
         return (self.x1 <= other.x2 and self.x2 >= other.x1 and
                 self.y1 <= other.y2 and self.y2 >= other.y1)
 
-class Tile:
-    def __init__(self, blocked, block_sight = None):
-        self.explored = False
-        self.blocked = blocked
+tile_dtype = np.dtype([('blocked', bool), ('block_sight', bool), ('explored', bool)])
 
+class TileGrid:
+    def __init__(self, width, height, blocked=True, block_sight=None):
         if block_sight is None:
             block_sight = blocked
 
-        self.block_sight = block_sight
+        self.width = width
+        self.height = height
+
+        # one structured record per tile; map[x][y] is a view, so map[x][y].explored = True writes through
+        self.tiles = np.zeros((width, height), dtype=tile_dtype).view(np.recarray)
+        self.tiles.blocked[...] = blocked
+        self.tiles.block_sight[...] = block_sight
+
+    def __getitem__(self, x):
+        return self.tiles[x]
+
+    def __len__(self):
+        return self.width
+
+    # whole-array views, indexed [x, y]
+    @property
+    def blocked(self):
+        return self.tiles.blocked
+
+    @property
+    def block_sight(self):
+        return self.tiles.block_sight
+
+    @property
+    def explored(self):
+        return self.tiles.explored
+
+    # bulk carving: every call opens a whole slice or mask at once
+    def carve(self, index):
+        self.tiles.blocked[index] = False
+        self.tiles.block_sight[index] = False
+
+    def carve_rect(self, x1, y1, x2, y2):
+        # half-open like range(): x1 <= x < x2, y1 <= y < y2
+        self.carve((slice(x1, x2), slice(y1, y2)))
+
+    def carve_h_line(self, x1, x2, y):
+        self.carve((slice(min(x1, x2), max(x1, x2) + 1), y))
+
+    def carve_v_line(self, y1, y2, x):
+        self.carve((x, slice(min(y1, y2), max(y1, y2) + 1)))
+
+    def carve_l(self, x1, y1, x2, y2, horizontal_first=True):
+        if horizontal_first:
+            self.carve_h_line(x1, x2, y1)
+            self.carve_v_line(y1, y2, x2)
+        else:
+            self.carve_v_line(y1, y2, x1)
+            self.carve_h_line(x1, x2, y2)
+
+    def carve_mask(self, mask):
+        self.carve(np.asarray(mask, dtype=bool))
 
 
 class Object:
@@ -225,9 +276,9 @@ class Object:
     def move_astar(self, target):
         fov = tcod.map_new(MAP_WIDTH, MAP_HEIGHT)
 
-        for y1 in range(MAP_HEIGHT):
-            for x1 in range(MAP_WIDTH):
-                tcod.map_set_properties(fov, x1, y1, not map[x1][y1].block_sight, not map[x1][y1].blocked)
+        # the tcod map is indexed [y, x], the tile arrays [x, y]
+        fov.transparent[...] = ~map.block_sight.T
+        fov.walkable[...] = ~map.blocked.T
 
         for obj in objects:
             if obj.blocks and obj != self and obj != target:
@@ -348,7 +399,7 @@ def make_map():
 
     objects = [player]
 
-    map = [ [Tile(True) for y in range(MAP_HEIGHT)] for x in range(MAP_WIDTH) ]
+    map = TileGrid(MAP_WIDTH, MAP_HEIGHT)
 
     rooms = []
     num_rooms = 0
@@ -385,12 +436,9 @@ def make_map():
             else:
                 (prev_x, prev_y) = rooms[num_rooms-1].center()
 
-                if tcod.random_get_int(0, 0, 1) == 1:
-                    create_h_tunnel(prev_x, new_x, prev_y)
-                    create_v_tunnel(prev_y, new_y, new_x)
-                else:
-                    create_v_tunnel(prev_y, new_y, prev_x)
-                    create_h_tunnel(prev_x, new_x, new_y)
+                # L-shaped corridor, horizontal or vertical leg first
+                horizontal_first = tcod.random_get_int(0, 0, 1) == 1
+                map.carve_l(prev_x, prev_y, new_x, new_y, horizontal_first)
 
                 place_objects(new_room)
 
@@ -403,26 +451,13 @@ def make_map():
     stairs.send_to_back()
 
 def create_room(room):
-    global map
-
-    for x in range(room.x1 + 1, room.x2):
-        for y in range(room.y1 + 1, room.y2):
-            map[x][y].blocked = False
-            map[x][y].block_sight = False
+    map.carve_rect(room.x1 + 1, room.y1 + 1, room.x2, room.y2)
 
 def create_h_tunnel(x1, x2, y): # 가로
-    global map
-
-    for x in range(min(x1, x2), max(x1, x2) + 1):
-        map[x][y].blocked = False
-        map[x][y].block_sight = False
+    map.carve_h_line(x1, x2, y)
 
 def create_v_tunnel(y1, y2, x): # 세로
-    global map
-
-    for y in range(min(y1, y2), max(y1, y2) + 1):
-        map[x][y].blocked = False
-        map[x][y].block_sight = False
+    map.carve_v_line(y1, y2, x)
 
 def place_objects(room):
 
@@ -498,7 +533,7 @@ def place_objects(room):
 
 
 def is_blocked(x, y):
-    if map[x][y].blocked:
+    if map.blocked[x, y]:
         return True
 
     for object in objects:
@@ -805,15 +840,23 @@ def render_all():
         fov_recompute = False
         tcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
 
+        # read the whole FOV and the tile arrays once; plain lists are much faster than numpy per tile
+        in_view = fov_map.fov.T
+        if EXPLORE_MODE:
+            map.explored[in_view] = True
+        in_view = in_view.tolist()
+        walls = map.block_sight.tolist()
+        explored = map.explored.tolist()
+
         # go through all tiles, and set their background color according to the FOV
         for y in range(MAP_HEIGHT):
             for x in range(MAP_WIDTH):
-                visible = tcod.map_is_in_fov(fov_map, x, y)
-                wall = map[x][y].block_sight
+                visible = in_view[x][y]
+                wall = walls[x][y]
                 if EXPLORE_MODE:
                     if not visible:
                         # it's out of the player's FOV
-                        if map[x][y].explored:
+                        if explored[x][y]:
                             if wall:
                                 tcod.console_set_char_background(con, x, y, color_dark_wall, tcod.BKGND_SET)
                             else:
@@ -825,8 +868,6 @@ def render_all():
                         else:
                             tcod.console_set_char_background(con, x, y, color_light_ground, tcod.BKGND_SET)
 
-                        map[x][y].explored = True
-
                 else:
                     if not visible:
                         # it's out of the player's FOV
@@ -1048,10 +1089,10 @@ def initialize_fov():
 
     fov_recompute = True
 
+    # the tcod map is indexed [y, x], the tile arrays [x, y]
     fov_map = tcod.map_new(MAP_WIDTH, MAP_HEIGHT)
-    for y in range(MAP_HEIGHT):
-        for x in range(MAP_WIDTH):
-            tcod.map_set_properties(fov_map, x, y, not map[x][y].block_sight, not map[x][y].blocked)
+    fov_map.transparent[...] = ~map.block_sight.T
+    fov_map.walkable[...] = ~map.blocked.T
 
     tcod.console_clear(con)
 
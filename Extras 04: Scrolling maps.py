@@ -1,7 +1,13 @@
 import tcod
+import numpy as np
 import math
+import os
+import pickle
+import zlib
 import textwrap
 import shelve
+import shutil
+import tempfile
 
 SCREEN_WIDTH = 80
 SCREEN_HEIGHT = 50
@@ -10,8 +16,11 @@ WINDOW_TITLE = "Python 3 tcod tutorial"
 FULL_SCREEN = False
 LIMIT_FPS = 20
 
-MAP_WIDTH = 100
-MAP_HEIGHT = 100
+CHUNK_SIZE = 32
+
+# the world is only ever held as the chunks around the camera, so it can be huge
+MAP_WIDTH = 64 * CHUNK_SIZE
+MAP_HEIGHT = 64 * CHUNK_SIZE
 
 CAMERA_WIDTH = 80
 CAMERA_HEIGHT = 43
@@ -31,7 +40,12 @@ DEFAULT_ATTACK_SPEED = 20
 
 ROOM_MAX_SIZE = 10
 ROOM_MIN_SIZE = 6
-MAX_ROOMS = 30
+CHUNK_MAX_ROOMS = 4
+
+CHUNK_LOAD_MARGIN = 1 # chunks generated/loaded ahead of the camera
+CHUNK_EVICT_DISTANCE = 3 # chunks further than this from the camera are spilled to disk
+CHUNK_DIR = 'savegame_chunks' # each running game spills its far chunks into its own directory under here
+STAIRS_CHUNK_RANGE = 3 # the stairs are at most this many chunks away from the start
 
 EXPLORE_MODE = False
 
@@ -125,7 +139,7 @@ class Fighter:
 class BasicMonster:
     def take_turn(self):
         monster = self.owner
-        if tcod.map_is_in_fov(fov_map, monster.x, monster.y):
+        if in_fov(monster.x, monster.y):
 
             if monster.distance_to(player) >= 2:
                 monster.move_astar(player)
@@ -163,15 +177,164 @@ class Rect:
         return (self.x1 <= other.x2 and self.x2 >= other.x1 and
                 self.y1 <= other.y2 and self.y2 >= other.y1)
 
-class Tile:
-    def __init__(self, blocked, block_sight = None):
-        self.explored = False
-        self.blocked = blocked
+tile_dtype = np.dtype([('blocked', bool), ('block_sight', bool), ('explored', bool)])
 
+class TileGrid:
+    def __init__(self, width, height, blocked=True, block_sight=None):
         if block_sight is None:
             block_sight = blocked
 
-        self.block_sight = block_sight
+        self.width = width
+        self.height = height
+
+        # one structured record per tile; map[x][y] is a view, so map[x][y].explored = True writes through
+        self.tiles = np.zeros((width, height), dtype=tile_dtype).view(np.recarray)
+        self.tiles.blocked[...] = blocked
+        self.tiles.block_sight[...] = block_sight
+
+    def __getitem__(self, x):
+        return self.tiles[x]
+
+    def __len__(self):
+        return self.width
+
+    # whole-array views, indexed [x, y]
+    @property
+    def blocked(self):
+        return self.tiles.blocked
+
+    @property
+    def block_sight(self):
+        return self.tiles.block_sight
+
+    @property
+    def explored(self):
+        return self.tiles.explored
+
+    # bulk carving: every call opens a whole slice or mask at once
+    def carve(self, index):
+        self.tiles.blocked[index] = False
+        self.tiles.block_sight[index] = False
+
+    def carve_rect(self, x1, y1, x2, y2):
+        # half-open like range(): x1 <= x < x2, y1 <= y < y2
+        self.carve((slice(x1, x2), slice(y1, y2)))
+
+    def carve_h_line(self, x1, x2, y):
+        self.carve((slice(min(x1, x2), max(x1, x2) + 1), y))
+
+    def carve_v_line(self, y1, y2, x):
+        self.carve((x, slice(min(y1, y2), max(y1, y2) + 1)))
+
+    def carve_l(self, x1, y1, x2, y2, horizontal_first=True):
+        if horizontal_first:
+            self.carve_h_line(x1, x2, y1)
+            self.carve_v_line(y1, y2, x2)
+        else:
+            self.carve_v_line(y1, y2, x1)
+            self.carve_h_line(x1, x2, y2)
+
+    def carve_mask(self, mask):
+        self.carve(np.asarray(mask, dtype=bool))
+
+
+class ChunkedMap:
+    # CHUNK_SIZE x CHUNK_SIZE TileGrids, generated the first time they're touched and spilled to disk when far away
+    def __init__(self, width, height, seed):
+        self.width = width
+        self.height = height
+        self.seed = seed
+
+        self.chunks = {} # (cx, cy) -> TileGrid
+        self.spilled = set()
+        self.directory = None # scratch directory of this run under CHUNK_DIR, made on the first spill
+
+    # map[x][y].blocked keeps working, it just finds the chunk first
+    def __getitem__(self, x):
+        return ChunkColumn(self, x)
+
+    def __len__(self):
+        return self.width
+
+    def __getstate__(self):
+        # the chunks themselves are saved by save_game(), the scratch files belong to the running game
+        state = self.__dict__.copy()
+        state['chunks'] = {}
+        state['spilled'] = set()
+        state['directory'] = None
+        return state
+
+    def chunk(self, cx, cy):
+        if (cx, cy) not in self.chunks:
+            load_chunk(self, cx, cy)
+
+        return self.chunks[(cx, cy)]
+
+    def chunk_seed(self, cx, cy, salt=0):
+        return (self.seed * 1000003 + cx * 7919 + cy * 104729 + salt * 15485863) & 0x7FFFFFFF
+
+    def door(self, cx, cy, salt):
+        # the crossing on a chunk edge depends only on the edge, so both neighbours agree on it
+        rng = tcod.random_new_from_seed(self.chunk_seed(cx, cy, salt))
+        return tcod.random_get_int(rng, 2, CHUNK_SIZE - 3)
+
+    def window(self, field, x0, y0, w, h):
+        # copy of one field over a rectangle of the world, indexed [x, y]
+        out = np.zeros((w, h), dtype=bool)
+        for cx in range(x0 // CHUNK_SIZE, (x0 + w - 1) // CHUNK_SIZE + 1):
+            for cy in range(y0 // CHUNK_SIZE, (y0 + h - 1) // CHUNK_SIZE + 1):
+                (left, top) = (cx * CHUNK_SIZE, cy * CHUNK_SIZE)
+                (x1, y1) = (max(x0, left), max(y0, top))
+                (x2, y2) = (min(x0 + w, left + CHUNK_SIZE), min(y0 + h, top + CHUNK_SIZE))
+                tiles = getattr(self.chunk(cx, cy), field)
+                out[x1 - x0:x2 - x0, y1 - y0:y2 - y0] = tiles[x1 - left:x2 - left, y1 - top:y2 - top]
+        return out
+
+    def path(self, cx, cy):
+        return os.path.join(self.directory, 'chunk_' + str(cx) + '_' + str(cy) + '.bin')
+
+    def pack(self, cx, cy, chunk_objects):
+        return zlib.compress(pickle.dumps((self.chunks[(cx, cy)], chunk_objects), pickle.HIGHEST_PROTOCOL))
+
+    def packed(self, cx, cy):
+        with open(self.path(cx, cy), 'rb') as file:
+            return file.read()
+
+    def write(self, cx, cy, data):
+        if self.directory is None:
+            os.makedirs(CHUNK_DIR, exist_ok=True)
+            self.directory = tempfile.mkdtemp(prefix='run_', dir=CHUNK_DIR)
+
+        with open(self.path(cx, cy), 'wb') as file:
+            file.write(data)
+        self.spilled.add((cx, cy))
+
+    def spill(self, cx, cy, chunk_objects):
+        self.write(cx, cy, self.pack(cx, cy, chunk_objects))
+        del self.chunks[(cx, cy)]
+
+    def read(self, cx, cy):
+        (tiles, chunk_objects) = pickle.loads(zlib.decompress(self.packed(cx, cy)))
+        os.remove(self.path(cx, cy))
+        self.spilled.remove((cx, cy))
+        return (tiles, chunk_objects)
+
+    def clear(self):
+        self.chunks.clear()
+        self.spilled.clear()
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+
+class ChunkColumn:
+    def __init__(self, chunked_map, x):
+        self.chunked_map = chunked_map
+        self.x = x
+
+    def __getitem__(self, y):
+        tiles = self.chunked_map.chunk(self.x // CHUNK_SIZE, y // CHUNK_SIZE)
+        return tiles[self.x % CHUNK_SIZE][y % CHUNK_SIZE]
 
 
 class Object:
@@ -226,25 +389,31 @@ class Object:
         self.move(dx, dy)
 
     def move_astar(self, target):
-        fov = tcod.map_new(MAP_WIDTH, MAP_HEIGHT)
+        # paths are searched inside the FOV window only, the whole world is far too big for it
+        (x0, y0) = (self.x - fov_x, self.y - fov_y)
+        if x0 < 0 or y0 < 0 or x0 >= CAMERA_WIDTH or y0 >= CAMERA_HEIGHT:
+            self.move_towards(target.x, target.y)
+            return
 
-        for y1 in range(MAP_HEIGHT):
-            for x1 in range(MAP_WIDTH):
-                tcod.map_set_properties(fov, x1, y1, not map[x1][y1].block_sight, not map[x1][y1].blocked)
+        fov = tcod.map_new(CAMERA_WIDTH, CAMERA_HEIGHT)
+        fov.transparent[...] = fov_map.transparent
+        fov.walkable[...] = fov_map.walkable
 
         for obj in objects:
             if obj.blocks and obj != self and obj != target:
-                tcod.map_set_properties(fov, obj.x, obj.y, True, False)
+                (x1, y1) = (obj.x - fov_x, obj.y - fov_y)
+                if 0 <= x1 < CAMERA_WIDTH and 0 <= y1 < CAMERA_HEIGHT:
+                    tcod.map_set_properties(fov, x1, y1, True, False)
 
         path = tcod.path_new_using_map(fov, 0) # 0: 대각선 금지, 1.41: 대각선 코스트(루트 2)
 
-        tcod.path_compute(path, self.x, self.y, target.x, target.y)
+        tcod.path_compute(path, x0, y0, target.x - fov_x, target.y - fov_y)
 
         if not tcod.path_is_empty(path) and tcod.path_size(path) < 25:
             x, y = tcod.path_walk(path, True)
             if x or y:
-                self.x = x
-                self.y = y
+                self.x = x + fov_x
+                self.y = y + fov_y
                 self.wait = self.speed
         else:
             self.move_towards(target.x, target.y)
@@ -269,7 +438,7 @@ class Object:
         (x, y) = to_camera_coordinates(self.x, self.y)
 
         if EXPLORE_MODE:
-            visible = tcod.map_is_in_fov(fov_map, self.x, self.y) or self.always_visible
+            visible = in_fov(self.x, self.y) or self.always_visible
             if not visible:
                 return
 
@@ -357,83 +526,121 @@ def make_map():
 
     objects = [player]
 
-    map = [ [Tile(True) for y in range(MAP_HEIGHT)] for x in range(MAP_WIDTH) ]
+    map = ChunkedMap(MAP_WIDTH, MAP_HEIGHT, tcod.random_get_int(0, 0, 0x7FFFFFFF))
 
-    rooms = []
-    num_rooms = 0
+    # start in the middle of the world, stairs a few chunks away
+    map.start_chunk = (MAP_WIDTH // CHUNK_SIZE // 2, MAP_HEIGHT // CHUNK_SIZE // 2)
+    map.stairs_chunk = map.start_chunk
+    while map.stairs_chunk == map.start_chunk:
+        map.stairs_chunk = (map.start_chunk[0] + tcod.random_get_int(0, -STAIRS_CHUNK_RANGE, STAIRS_CHUNK_RANGE),
+                            map.start_chunk[1] + tcod.random_get_int(0, -STAIRS_CHUNK_RANGE, STAIRS_CHUNK_RANGE))
 
-    for r in range(MAX_ROOMS):
-        w = tcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
-        h = tcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
-        # random position without going out of the boundaries of the map
-        x = tcod.random_get_int(0, 0, MAP_WIDTH - w - 1)
-        y = tcod.random_get_int(0, 0, MAP_HEIGHT - h - 1)
+    start_rooms = map.chunk(*map.start_chunk).rooms
+    (player.x, player.y) = start_rooms[0].center()
 
-        new_room = Rect(x, y, w, h)
+    map.chunk(*map.stairs_chunk)
 
-        failed = False
-        for other_room in rooms:
-            if new_room.intersect(other_room):
-                failed = True
-                break
+def load_chunk(chunked_map, cx, cy):
+    global stairs
 
-        if not failed:
+    if (cx, cy) in chunked_map.spilled:
+        (tiles, chunk_objects) = chunked_map.read(cx, cy)
+        chunked_map.chunks[(cx, cy)] = tiles
+        objects.extend(chunk_objects)
 
-            create_room(new_room)
+        # the stairs come back as a new object with their chunk
+        if (cx, cy) == chunked_map.stairs_chunk:
+            stairs = next(obj for obj in chunk_objects if obj.name == 'stairs')
+        return
 
+    rng = tcod.random_new_from_seed(chunked_map.chunk_seed(cx, cy))
+    (left, top) = (cx * CHUNK_SIZE, cy * CHUNK_SIZE)
 
-            (new_x, new_y) = new_room.center()
-            #room_no = Object(new_x, new_y, chr(65 + num_rooms), 'room number', tcod.white, blocks=False)
-            #objects.insert(0, room_no)
-            #room_no.send_to_back()
+    tiles = TileGrid(CHUNK_SIZE, CHUNK_SIZE)
+    tiles.rooms = []
 
-            if num_rooms == 0:
-                player.x = new_x
-                player.y = new_y
-
-            else:
-                (prev_x, prev_y) = rooms[num_rooms-1].center()
-
-                if tcod.random_get_int(0, 0, 1) == 1:
-                    create_h_tunnel(prev_x, new_x, prev_y)
-                    create_v_tunnel(prev_y, new_y, new_x)
-                else:
-                    create_v_tunnel(prev_y, new_y, prev_x)
-                    create_h_tunnel(prev_x, new_x, new_y)
-
-                place_objects(new_room)
+    for r in range(CHUNK_MAX_ROOMS):
+        w = tcod.random_get_int(rng, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+        h = tcod.random_get_int(rng, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+        # random position inside the chunk, leaving its border for the crossings
+        x = tcod.random_get_int(rng, 1, CHUNK_SIZE - w - 2)
+        y = tcod.random_get_int(rng, 1, CHUNK_SIZE - h - 2)
 
+        new_room = Rect(x, y, w, h)
 
-            rooms.append(new_room)
-            num_rooms += 1
+        failed = False
+        for other_room in tiles.rooms:
+            if new_room.intersect(other_room):
+                failed = True
+                break
 
-    stairs = Object(new_x, new_y, '<', "stairs", tcod.white, always_visible=True)
-    objects.append(stairs)
-    stairs.send_to_back()
+        if not failed:
+            tiles.carve_rect(new_room.x1 + 1, new_room.y1 + 1, new_room.x2, new_room.y2)
+
+            if tiles.rooms:
+                (prev_x, prev_y) = tiles.rooms[-1].center()
+                (new_x, new_y) = new_room.center()
+                horizontal_first = tcod.random_get_int(rng, 0, 1) == 1
+                tiles.carve_l(prev_x, prev_y, new_x, new_y, horizontal_first)
+
+            tiles.rooms.append(new_room)
+
+    # corridors from the first room out to the crossings shared with the neighbouring chunks
+    (first_x, first_y) = tiles.rooms[0].center()
+    if cx > 0:
+        tiles.carve_l(0, chunked_map.door(cx - 1, cy, 1), first_x, first_y, True)
+    if cx < chunked_map.width // CHUNK_SIZE - 1:
+        tiles.carve_l(CHUNK_SIZE - 1, chunked_map.door(cx, cy, 1), first_x, first_y, True)
+    if cy > 0:
+        tiles.carve_l(chunked_map.door(cx, cy - 1, 2), 0, first_x, first_y, False)
+    if cy < chunked_map.height // CHUNK_SIZE - 1:
+        tiles.carve_l(chunked_map.door(cx, cy, 2), CHUNK_SIZE - 1, first_x, first_y, False)
+
+    # rooms are kept in world coordinates from here on
+    tiles.rooms = [Rect(left + room.x1, top + room.y1, room.x2 - room.x1, room.y2 - room.y1) for room in tiles.rooms]
+    chunked_map.chunks[(cx, cy)] = tiles
+
+    for (i, room) in enumerate(tiles.rooms):
+        if i > 0 or (cx, cy) != chunked_map.start_chunk:
+            place_objects(room, rng)
+
+    if (cx, cy) == chunked_map.stairs_chunk:
+        (new_x, new_y) = tiles.rooms[-1].center()
+        stairs = Object(new_x, new_y, '<', "stairs", tcod.white, always_visible=True)
+        objects.append(stairs)
+        stairs.send_to_back()
+
+def stream_chunks():
+    # load what the camera is about to see, spill what it left far behind
+    (lo_x, hi_x) = (camera_x // CHUNK_SIZE, (camera_x + CAMERA_WIDTH - 1) // CHUNK_SIZE)
+    (lo_y, hi_y) = (camera_y // CHUNK_SIZE, (camera_y + CAMERA_HEIGHT - 1) // CHUNK_SIZE)
+
+    for cx in range(max(0, lo_x - CHUNK_LOAD_MARGIN), min(MAP_WIDTH // CHUNK_SIZE - 1, hi_x + CHUNK_LOAD_MARGIN) + 1):
+        for cy in range(max(0, lo_y - CHUNK_LOAD_MARGIN), min(MAP_HEIGHT // CHUNK_SIZE - 1, hi_y + CHUNK_LOAD_MARGIN) + 1):
+            map.chunk(cx, cy)
+
+    for (cx, cy) in list(map.chunks):
+        if (cx < lo_x - CHUNK_EVICT_DISTANCE or cx > hi_x + CHUNK_EVICT_DISTANCE or
+                cy < lo_y - CHUNK_EVICT_DISTANCE or cy > hi_y + CHUNK_EVICT_DISTANCE):
+            evict_chunk(cx, cy)
+
+def chunk_objects(cx, cy):
+    return [obj for obj in objects if obj != player and obj.x // CHUNK_SIZE == cx and obj.y // CHUNK_SIZE == cy]
+
+def evict_chunk(cx, cy):
+    map.spill(cx, cy, chunk_objects(cx, cy))
+    objects[:] = [obj for obj in objects if obj == player or obj.x // CHUNK_SIZE != cx or obj.y // CHUNK_SIZE != cy]
 
 def create_room(room):
-    global map
-
-    for x in range(room.x1 + 1, room.x2):
-        for y in range(room.y1 + 1, room.y2):
-            map[x][y].blocked = False
-            map[x][y].block_sight = False
+    map.carve_rect(room.x1 + 1, room.y1 + 1, room.x2, room.y2)
 
 def create_h_tunnel(x1, x2, y): # 가로
-    global map
-
-    for x in range(min(x1, x2), max(x1, x2) + 1):
-        map[x][y].blocked = False
-        map[x][y].block_sight = False
+    map.carve_h_line(x1, x2, y)
 
 def create_v_tunnel(y1, y2, x): # 세로
-    global map
-
-    for y in range(min(y1, y2), max(y1, y2) + 1):
-        map[x][y].blocked = False
-        map[x][y].block_sight = False
+    map.carve_v_line(y1, y2, x)
 
-def place_objects(room):
+def place_objects(room, rng=0):
 
     max_monsters = from_dungeon_level([[2, 1], [3, 4], [5, 6]])
 
@@ -442,11 +649,11 @@ def place_objects(room):
     monster_chances["troll"] = from_dungeon_level([[15, 3], [30, 5], [60, 7]])
 
     for i in range(0, max_monsters):
-        x = tcod.random_get_int(0, room.x1 + 1, room.x2 - 1)
-        y = tcod.random_get_int(0, room.y1 + 1, room.y2 - 1)
+        x = tcod.random_get_int(rng, room.x1 + 1, room.x2 - 1)
+        y = tcod.random_get_int(rng, room.y1 + 1, room.y2 - 1)
 
         if not is_blocked(x, y):
-            choice = random_choice(monster_chances)
+            choice = random_choice(monster_chances, rng)
 
             if choice == "orc":  # 80% chance of getting an orc
                 fighter_component = Fighter(hp=20, defense=0, power=4, xp=35, death_function=monster_death)
@@ -472,11 +679,11 @@ def place_objects(room):
     item_chances["shield"] = from_dungeon_level([[15, 8]])
 
     for i in range(0, max_items):
-        x = tcod.random_get_int(0, room.x1 + 1, room.x2 - 1)
-        y = tcod.random_get_int(0, room.y1 + 1, room.y2 - 1)
+        x = tcod.random_get_int(rng, room.x1 + 1, room.x2 - 1)
+        y = tcod.random_get_int(rng, room.y1 + 1, room.y2 - 1)
 
         if not is_blocked(x, y):
-            choice = random_choice(item_chances)
+            choice = random_choice(item_chances, rng)
 
             if choice == 'heal':
                 item_component = Item(use_function=cast_heal)
@@ -596,7 +803,7 @@ def closest_monster(max_range):
     closest_dist = max_range + 1
 
     for object in objects:
-        if object.fighter and not object == player and tcod.map_is_in_fov(fov_map, object.x, object.y):
+        if object.fighter and not object == player and in_fov(object.x, object.y):
             dist = player.distance_to(object)
             if dist < closest_dist:
                 closest_enemy = object
@@ -613,9 +820,9 @@ def target_tile(max_range=None):
         tcod.sys_check_for_event(tcod.EVENT_KEY | tcod.EVENT_MOUSE, key, mouse)
         render_all()
 
-        (x, y) = (mouse.cx, mouse.cy)
+        (x, y) = (mouse.cx + camera_x, mouse.cy + camera_y)
 
-        if mouse.lbutton_pressed and tcod.map_is_in_fov(fov_map, x, y) and (max_range is None or player.distance(x, y) <= max_range):
+        if mouse.lbutton_pressed and in_fov(x, y) and (max_range is None or player.distance(x, y) <= max_range):
             return (x, y)
 
         if mouse.rbutton_pressed or key.vk == tcod.KEY_ESCAPE:
@@ -757,9 +964,9 @@ def check_level_up():
             player.fighter.base_defense += 1
 
 
-def random_choice_index(chances):
+def random_choice_index(chances, rng=0):
 
-    dice = tcod.random_get_int(0, 1, sum(chances))
+    dice = tcod.random_get_int(rng, 1, sum(chances))
 
     running_sum = 0
     choice = 0
@@ -772,11 +979,11 @@ def random_choice_index(chances):
 
         choice += 1
 
-def random_choice(chances_dict):
+def random_choice(chances_dict, rng=0):
     chances = chances_dict.values()
     strings = list(chances_dict.keys())
 
-    return strings[random_choice_index(chances)]
+    return strings[random_choice_index(chances, rng)]
 
 
 def from_dungeon_level(table):
@@ -817,10 +1024,15 @@ def move_camera(target_x, target_y):
     if x < 0: x = 0
     if y < 0: y = 0
 
-    if x != camera_x or y != camera_y: fov_recompute = True
+    if x == camera_x and y == camera_y:
+        return
 
+    fov_recompute = True
     (camera_x, camera_y) = (x, y)
 
+    stream_chunks()
+    update_fov_window()
+
 
 def to_camera_coordinates(x, y):
     (x, y) = (x - camera_x, y - camera_y)
@@ -841,14 +1053,17 @@ def render_all():
     if fov_recompute:
         # recompute FOV if needed (the player moved or something)
         fov_recompute = False
-        tcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
+        tcod.map_compute_fov(fov_map, player.x - fov_x, player.y - fov_y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
+
+        # the FOV window is the camera, so window and screen coordinates are the same
+        walls = map.window('block_sight', camera_x, camera_y, CAMERA_WIDTH, CAMERA_HEIGHT)
 
         # go through all tiles, and set their background color according to the FOV
         for y in range(CAMERA_HEIGHT):
             for x in range(CAMERA_WIDTH):
                 (map_x, map_y) = (camera_x + x, camera_y + y)
-                visible = tcod.map_is_in_fov(fov_map, map_x, map_y)
-                wall = map[map_x][map_y].block_sight
+                visible = tcod.map_is_in_fov(fov_map, x, y)
+                wall = walls[x, y]
                 if EXPLORE_MODE:
                     if not visible:
                         # it's out of the player's FOV
@@ -1011,7 +1226,7 @@ def get_names_under_mouse():
     (x, y) = (mouse.cx, mouse.cy)
     (x, y) = (x + camera_x, y + camera_y)
 
-    names = [obj.name for obj in objects if obj.x == x and obj.y == y and tcod.map_is_in_fov(fov_map, obj.x, obj.y)]
+    names = [obj.name for obj in objects if obj.x == x and obj.y == y and in_fov(obj.x, obj.y)]
 
     names = ','.join(names)
 
@@ -1051,6 +1266,7 @@ def next_level():
     player.fighter.heal(player.fighter.max_hp // 2)
 
     message('After a rare moment of peace, you descend deeper into the heart of the dungeon...', tcod.red)
+    map.clear()
     make_map()
     initialize_fov()
 
@@ -1084,22 +1300,37 @@ def new_game():
 
 
 def initialize_fov():
-    global fov_map, fov_recompute
+    global fov_map, fov_recompute, camera_x, camera_y
 
     fov_recompute = True
 
-    fov_map = tcod.map_new(MAP_WIDTH, MAP_HEIGHT)
-    for y in range(MAP_HEIGHT):
-        for x in range(MAP_WIDTH):
-            tcod.map_set_properties(fov_map, x, y, not map[x][y].block_sight, not map[x][y].blocked)
+    # the FOV map only covers the camera; move_camera() refills it from the chunks whenever the camera moves
+    fov_map = tcod.map_new(CAMERA_WIDTH, CAMERA_HEIGHT)
+    (camera_x, camera_y) = (None, None)
+    move_camera(player.x, player.y)
 
     tcod.console_clear(con)
 
 
-def play_game():
-    global camera_x, camera_y, key, mouse
+def update_fov_window():
+    global fov_x, fov_y
 
-    (camera_x, camera_y) = (0, 0)
+    (fov_x, fov_y) = (camera_x, camera_y)
+    fov_map.transparent[...] = ~map.window('block_sight', fov_x, fov_y, CAMERA_WIDTH, CAMERA_HEIGHT).T
+    fov_map.walkable[...] = ~map.window('blocked', fov_x, fov_y, CAMERA_WIDTH, CAMERA_HEIGHT).T
+
+
+def in_fov(x, y):
+    (x, y) = (x - fov_x, y - fov_y)
+
+    if x < 0 or y < 0 or x >= CAMERA_WIDTH or y >= CAMERA_HEIGHT:
+        return False
+
+    return tcod.map_is_in_fov(fov_map, x, y)
+
+
+def play_game():
+    global key, mouse
 
     while not tcod.console_is_window_closed():
         tcod.sys_check_for_event(tcod.EVENT_KEY_PRESS | tcod.EVENT_MOUSE, key, mouse)
@@ -1117,6 +1348,7 @@ def play_game():
         player_action = handle_keys()
         if player_action == 'exit':
             save_game()
+            map.clear()
             break
 
         if game_state == "playing":
@@ -1128,34 +1360,42 @@ def play_game():
                         object.ai.take_turn()
 
 def save_game():
+    # the save carries every visited chunk itself, so it stays loadable whatever happens to the scratch files
+    chunks = {(cx, cy): map.packed(cx, cy) for (cx, cy) in map.spilled}
+    for (cx, cy) in map.chunks:
+        chunks[(cx, cy)] = map.pack(cx, cy, chunk_objects(cx, cy))
 
     file = shelve.open("savegame", "n")
     file["map"] = map
-    file["objects"] = objects
-    file["player_index"] = objects.index(player)
+    file['chunks'] = chunks
+    file["player"] = player
     file['inventory'] = inventory
     file['game_msgs'] = game_msgs
     file['game_state'] = game_state
-    file['stairs_index'] = objects.index(stairs)
     file['dungeon_level'] = dungeon_level
 
     file.close()
 
 def load_game():
-    global map, objects, player, inventory, game_msgs, game_state, stairs, dungeon_level
+    global map, objects, player, inventory, game_msgs, game_state, dungeon_level
 
     file = shelve.open("savegame", "r")
     map = file["map"]
-    objects = file['objects']
-    player = objects[file['player_index']]  # get index of player in objects list and access it
+    chunks = file['chunks']
+    player = file['player']
     inventory = file['inventory']
     game_msgs = file['game_msgs']
     game_state = file['game_state']
-    stairs = objects[file['stairs_index']]
     dungeon_level = file['dungeon_level']
 
     file.close()
 
+    # the saved chunks start out spilled into this run's scratch directory; the stairs chunk is loaded for the stairs
+    for ((cx, cy), data) in chunks.items():
+        map.write(cx, cy, data)
+
+    objects = [player]
+    map.chunk(*map.stairs_chunk)
     initialize_fov()
 
 
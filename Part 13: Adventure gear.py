@@ -1,7 +1,17 @@
 import tcod
+import numpy as np
 import math
+import os
+import pickle
+import zlib
 import textwrap
 import shelve
+import shutil
+import tempfile
+import threading
+import collections
+import functools
+import time
 
 SCREEN_WIDTH = 80
 SCREEN_HEIGHT = 50
@@ -9,6 +19,12 @@ SCREEN_HEIGHT = 50
 WINDOW_TITLE = "Python 3 tcod tutorial"
 FULL_SCREEN = False
 LIMIT_FPS = 20
+MENU_CONSOLE_POOL_SIZE = 4 # off-screen consoles kept for menus, one per size
+PROFILE_WINDOW = 120 # frames the profiler's rolling p50/p99 and FPS cover
+PROFILE_LOG = 'frame_profile.log' # one line per frame while the profiler is on (F3)
+TURN_BASED = True # sleep until there is input instead of redrawing LIMIT_FPS times a second
+TURN_TIMEOUT = None # seconds to wait for input before redrawing anyway (for animations), None waits forever
+HEADLESS_FRAMES = 16 # flushed frames a HeadlessBackend keeps, newest last; pass max_frames=None to keep them all
 
 MAP_WIDTH = 80
 MAP_HEIGHT = 43
@@ -24,6 +40,20 @@ MSG_HEIGHT = PANEL_HEIGHT - 1
 ROOM_MAX_SIZE = 10
 ROOM_MIN_SIZE = 6
 MAX_ROOMS = 30
+MAX_ROOM_ATTEMPTS = 10000 # upper bound when make_map() is asked for a target room count
+
+DUNGEON_GENERATOR = 'rooms' # 'rooms' or 'caves'
+
+CAVE_FILL_PROBABILITY = 0.45
+CAVE_SMOOTHING_PASSES = 4
+CAVE_SPAWN_AREAS = 20
+CAVE_SPAWN_AREA_SIZE = 6
+
+LEVEL_SEED_MAX = 0x7FFFFFFF
+GAME_SEED = None # set to replay the exact dungeon from a bug report
+
+LEVEL_CACHE_SIZE = 3 # visited levels kept in memory, older ones are spilled to disk
+LEVEL_CACHE_DIR = 'savegame_levels' # each running game spills into its own directory under here
 
 EXPLORE_MODE = False
 
@@ -35,6 +65,17 @@ color_light_ground = tcod.Color(200, 180, 50)
 FOV_ALGO = 0  #default FOV algorithm
 FOV_LIGHT_WALLS = True
 TORCH_RADIUS = 7
+FOV_BACKEND = 'tcod' # 'tcod' or 'numpy', see FOV_BACKENDS
+FOV_CACHE_SIZE = 64 # FOV masks kept for recently visited positions
+LIGHT_LEVELS = 16 # shades between the dark and the light color of a visible tile
+
+# render layers, drawn bottom to top
+LAYER_DECAL = 0 # stairs and other things lying flat on the floor
+LAYER_ITEM = 1
+LAYER_CORPSE = 2
+LAYER_ACTOR = 3
+LAYER_PLAYER = 4
+LAYER_COUNT = 5
 
 INVENTORY_WIDTH = 50
 
@@ -111,9 +152,9 @@ class Fighter:
             self.hp = self.max_hp
 
 class BasicMonster:
-    def take_turn(self):
+    def take_turn(self, sees_player):
         monster = self.owner
-        if tcod.map_is_in_fov(fov_map, monster.x, monster.y):
+        if sees_player:
 
             if monster.distance_to(player) >= 2:
                 monster.move_towards(player.x, player.y)
@@ -125,7 +166,7 @@ class ConfuseMonster:
         self.old_ai = old_ai
         self.num_turns = num_turns
 
-    def take_turn(self):
+    def take_turn(self, sees_player):
         if self.num_turns > 0:
             self.owner.move(tcod.random_get_int(0, -1, 1), tcod.random_get_int(0, -1, 1))
             self.num_turns -= 1
@@ -151,19 +192,216 @@ class Rect:
         return (self.x1 <= other.x2 and self.x2 >= other.x1 and
                 self.y1 <= other.y2 and self.y2 >= other.y1)
 
-class Tile:
-    def __init__(self, blocked, block_sight = None):
-        self.explored = False
-        self.blocked = blocked
 
-        if block_sight is None:
-            block_sight = blocked
+class RoomIndex:
+    # accepted rooms bucketed by position, so an overlap test only looks at the rooms nearby
+    def __init__(self, bucket_size=ROOM_MAX_SIZE + 1):
+        self.bucket_size = bucket_size
+        self.buckets = collections.defaultdict(list)
+
+    def keys(self, room):
+        size = self.bucket_size
+        for bx in range(room.x1 // size, room.x2 // size + 1):
+            for by in range(room.y1 // size, room.y2 // size + 1):
+                yield (bx, by)
+
+    def add(self, room):
+        for key in self.keys(room):
+            self.buckets[key].append(room)
+
+    def intersects(self, room):
+        for key in self.keys(room):
+            for other_room in self.buckets.get(key, ()):
+                if room.intersect(other_room):
+                    return True
+
+        return False
+
+# terrain kinds are shared immutable descriptors; a map cell only stores the index of its kind
+TileType = collections.namedtuple('TileType', ['name', 'blocked', 'block_sight'])
+
+TILE_TYPES = []
+
+def register_tile_type(name, blocked, block_sight=None):
+    global TILE_BLOCKED, TILE_BLOCK_SIGHT
+
+    if block_sight is None:
+        block_sight = blocked
+
+    TILE_TYPES.append(TileType(name, blocked, block_sight))
+
+    # lookup tables, TILE_BLOCKED[map.types] gives the whole blocked array
+    TILE_BLOCKED = np.array([tile_type.blocked for tile_type in TILE_TYPES], dtype=bool)
+    TILE_BLOCK_SIGHT = np.array([tile_type.block_sight for tile_type in TILE_TYPES], dtype=bool)
+
+    return len(TILE_TYPES) - 1
+
+def tile_type_for(blocked, block_sight):
+    for (type_id, tile_type) in enumerate(TILE_TYPES):
+        if tile_type.blocked == blocked and tile_type.block_sight == block_sight:
+            return type_id
+
+    return register_tile_type('custom', blocked, block_sight)
+
+def tile_types_for(blocked, block_sight):
+    # type ids for whole flag arrays; 'custom' ids only exist in this process, so saves keep the flags
+    types = np.empty(np.shape(blocked), dtype=np.uint8)
+    for (cell_blocked, cell_block_sight) in set(zip(np.ravel(blocked).tolist(), np.ravel(block_sight).tolist())):
+        types[(blocked == cell_blocked) & (block_sight == cell_block_sight)] = tile_type_for(cell_blocked, cell_block_sight)
+    return types
+
+TILE_WALL = register_tile_type('wall', True)
+TILE_FLOOR = register_tile_type('floor', False)
+
+
+class TileGrid:
+    def __init__(self, width, height, tile_type=TILE_WALL):
+        self.width = width
+        self.height = height
+
+        self.types = np.full((width, height), tile_type, dtype=np.uint8)
+        # one bit per tile, row-major over [x, y] like np.packbits(mask); saved as these raw bytes
+        self.explored_bits = np.zeros((width * height + 7) // 8, dtype=np.uint8)
+
+        self.flags = None
+
+        self.version = 0 # bumped on every tile change, so derived data can tell it is stale
+        self.generated_version = None # version when make_map() finished; anything after goes into the level diff
+        self.on_change = None # called with the changed index, e.g. to keep the FOV map in sync
+
+    def __getstate__(self):
+        # blocked/block_sight are derived from the types, no need to save them
+        state = self.__dict__.copy()
+        state['flags'] = None
+        state['on_change'] = None
+        return state
+
+    # map[x][y].blocked and friends still work for old code
+    def __getitem__(self, x):
+        return TileColumn(self, x)
+
+    def __len__(self):
+        return self.width
+
+    def type_flags(self):
+        if self.flags is None:
+            self.flags = (TILE_BLOCKED[self.types], TILE_BLOCK_SIGHT[self.types])
+
+        return self.flags
+
+    # whole-array views, indexed [x, y]; change tiles through set_type(), not through these
+    @property
+    def blocked(self):
+        return self.type_flags()[0]
+
+    @property
+    def block_sight(self):
+        return self.type_flags()[1]
+
+    # unpacked copy, indexed [x, y]; mark tiles with explore() or map[x][y].explored
+    @property
+    def explored(self):
+        bits = np.unpackbits(self.explored_bits, count=self.width * self.height)
+        return bits.reshape(self.width, self.height).astype(bool)
+
+    def explore(self, mask):
+        self.explored_bits |= np.packbits(mask)
+
+    def is_explored(self, x, y):
+        i = x * self.height + y
+        return bool(self.explored_bits[i >> 3] & (0x80 >> (i & 7)))
+
+    def set_explored(self, x, y, value):
+        i = x * self.height + y
+        if value:
+            self.explored_bits[i >> 3] |= 0x80 >> (i & 7)
+        else:
+            self.explored_bits[i >> 3] &= ~(0x80 >> (i & 7)) & 0xFF
+
+    def set_type(self, index, tile_type):
+        self.types[index] = tile_type
+
+        if self.flags is not None:
+            self.flags[0][index] = TILE_BLOCKED[tile_type]
+            self.flags[1][index] = TILE_BLOCK_SIGHT[tile_type]
+
+        self.version += 1
+        if self.on_change is not None:
+            self.on_change(index)
+
+    # bulk carving: every call opens a whole slice or mask at once
+    def carve(self, index):
+        self.set_type(index, TILE_FLOOR)
+
+    def carve_rect(self, x1, y1, x2, y2):
+        # half-open like range(): x1 <= x < x2, y1 <= y < y2
+        self.carve((slice(x1, x2), slice(y1, y2)))
+
+    def carve_h_line(self, x1, x2, y):
+        self.carve((slice(min(x1, x2), max(x1, x2) + 1), y))
+
+    def carve_v_line(self, y1, y2, x):
+        self.carve((x, slice(min(y1, y2), max(y1, y2) + 1)))
+
+    def carve_l(self, x1, y1, x2, y2, horizontal_first=True):
+        if horizontal_first:
+            self.carve_h_line(x1, x2, y1)
+            self.carve_v_line(y1, y2, x2)
+        else:
+            self.carve_v_line(y1, y2, x1)
+            self.carve_h_line(x1, x2, y2)
+
+    def carve_mask(self, mask):
+        self.carve(np.asarray(mask, dtype=bool))
+
+
+class TileColumn:
+    def __init__(self, grid, x):
+        self.grid = grid
+        self.x = x
+
+    def __getitem__(self, y):
+        return TileRef(self.grid, self.x, y)
+
 
-        self.block_sight = block_sight
+class TileRef:
+    # one cell of a TileGrid; writing blocked/block_sight switches the cell to the kind with those flags
+    def __init__(self, grid, x, y):
+        self.grid = grid
+        self.x = x
+        self.y = y
+
+    @property
+    def type(self):
+        return TILE_TYPES[self.grid.types[self.x, self.y]]
+
+    @property
+    def blocked(self):
+        return self.type.blocked
+
+    @blocked.setter
+    def blocked(self, value):
+        self.grid.set_type((self.x, self.y), tile_type_for(value, self.type.block_sight))
+
+    @property
+    def block_sight(self):
+        return self.type.block_sight
+
+    @block_sight.setter
+    def block_sight(self, value):
+        self.grid.set_type((self.x, self.y), tile_type_for(self.type.blocked, value))
+
+    @property
+    def explored(self):
+        return self.grid.is_explored(self.x, self.y)
+
+    @explored.setter
+    def explored(self, value):
+        self.grid.set_explored(self.x, self.y, value)
 
 
 class Object:
-    def __init__(self, x, y, char, name, color, blocks = False, always_visible=False, fighter = None, ai = None, item = None, equipment = None):
+    def __init__(self, x, y, char, name, color, blocks = False, always_visible=False, fighter = None, ai = None, item = None, equipment = None, light = None, layer = None):
         self.x = x
         self.y = y
         self.char = char
@@ -171,6 +409,7 @@ class Object:
         self.color = color
         self.blocks = blocks
         self.always_visible = always_visible
+        self.spawn_id = None # index among the objects make_map() created, None for anything else
 
         self.fighter = fighter
         if self.fighter:
@@ -191,6 +430,19 @@ class Object:
             self.item = Item()
             self.item.owner = self
 
+        self.light = light
+        if self.light:
+            self.light.owner = self
+
+        if layer is None:
+            if self.fighter:
+                layer = LAYER_ACTOR
+            elif self.item:
+                layer = LAYER_ITEM
+            else:
+                layer = LAYER_DECAL
+        self.layer = layer # change it through objects.set_layer() while the object is on the level
+
 
     def move(self, dx, dy):
         global map
@@ -217,22 +469,12 @@ class Object:
     def distance(self, x, y):
         return math.sqrt((x - self.x) ** 2 + (y - self.y) ** 2)
 
-    def send_to_back(self):
-        global objects
-        objects.remove(self)
-        objects.insert(0, self)
-
-    def draw(self):
-        if EXPLORE_MODE:
-            visible = tcod.map_is_in_fov(fov_map, self.x, self.y) or self.always_visible
-            if not visible:
-                return
-
-        tcod.console_set_default_foreground(con, self.color)
-        tcod.console_put_char(con, self.x, self.y, self.char, tcod.BKGND_NONE)
+    def glyph(self):
+        # what the object shows on its tile, None while it can't be seen
+        if EXPLORE_MODE and not (self.always_visible or fov_mask[self.x, self.y]):
+            return None
 
-    def clear(self):
-        tcod.console_put_char(con, self.x, self.y, ' ', tcod.BKGND_NONE)
+        return (self.char, self.color)
 
 class Equipment:
     def __init__(self, slot, power_bonus=0, defense_bonus=0, max_hp_bonus=0):
@@ -285,6 +527,7 @@ class Item:
         else:
             inventory.append(self.owner)
             objects.remove(self.owner)
+            self.owner.spawn_id = None # from now on it's carried, not part of its level's spawn
             message('You picked up a ' + self.owner.name + '!', tcod.green)
 
             equipment = self.owner.equipment
@@ -303,101 +546,599 @@ class Item:
 
         message('You dropped a ' + self.owner.name + '.', tcod.yellow)
 
-def make_map():
-    global map, objects, stairs
+class ObjectLayers:
+    # the objects on the current level, one insertion-ordered dict per render layer; the draw order comes
+    # from the layer, so moving an object to another layer is O(1). Iterating gives a snapshot list,
+    # bottom layer first, so a loop may add or remove objects as it goes
+    def __init__(self, objects=()):
+        self.layers = [{} for i in range(LAYER_COUNT)]
+        for obj in objects:
+            self.append(obj)
+
+    def append(self, obj):
+        self.layers[obj.layer][obj] = None
+
+    def remove(self, obj):
+        del self.layers[obj.layer][obj]
+
+    def set_layer(self, obj, layer):
+        self.remove(obj)
+        obj.layer = layer
+        self.append(obj)
+
+    def __contains__(self, obj):
+        return obj in self.layers[obj.layer]
+
+    def __len__(self):
+        return sum(len(layer) for layer in self.layers)
+
+    def __iter__(self):
+        return iter([obj for layer in self.layers for obj in layer])
+
+class Level:
+    def __init__(self, dungeon_level, seed, map, objects, stairs, upstairs, start):
+        self.dungeon_level = dungeon_level
+        self.seed = seed
+        self.map = map
+        self.objects = objects # everything on the level except the player
+        self.stairs = stairs
+        self.upstairs = upstairs
+        self.start = start
+
+
+class LevelStore:
+    # visited levels by dungeon_level: the most recent ones in memory, the rest spilled to disk (LRU)
+    def __init__(self, capacity=LEVEL_CACHE_SIZE):
+        self.capacity = capacity
+        self.levels = collections.OrderedDict() # least recently used first
+        self.spilled = set()
+        self.directory = None # scratch directory of this run under LEVEL_CACHE_DIR, made on the first spill
+
+    def __contains__(self, level_num):
+        return level_num in self.levels or level_num in self.spilled
+
+    def path(self, level_num):
+        return os.path.join(self.directory, 'level_' + str(level_num) + '.bin')
+
+    def put(self, level):
+        self.levels[level.dungeon_level] = level
+        self.levels.move_to_end(level.dungeon_level)
+
+        while len(self.levels) > self.capacity:
+            (level_num, old_level) = self.levels.popitem(last=False)
+            self.spill(level_diff(old_level))
+
+    def take(self, level_num):
+        # the level leaves the store while it's being played, put() it back when leaving
+        if level_num in self.levels:
+            return self.levels.pop(level_num)
+
+        if level_num in self.spilled:
+            diff = self.read(level_num)
+            self.spilled.remove(level_num)
+            os.remove(self.path(level_num))
+            return restore_level(diff)
+
+        return None
+
+    # only the seed and a diff are written, the map itself is regenerated from the seed
+    def spill(self, diff):
+        if self.directory is None:
+            os.makedirs(LEVEL_CACHE_DIR, exist_ok=True)
+            self.directory = tempfile.mkdtemp(prefix='run_', dir=LEVEL_CACHE_DIR)
+
+        with open(self.path(diff['dungeon_level']), 'wb') as file:
+            file.write(zlib.compress(pickle.dumps(diff, pickle.HIGHEST_PROTOCOL)))
+        self.spilled.add(diff['dungeon_level'])
+
+    def read(self, level_num):
+        with open(self.path(level_num), 'rb') as file:
+            return pickle.loads(zlib.decompress(file.read()))
+
+    def diffs(self):
+        diffs = {level_num: level_diff(level) for (level_num, level) in self.levels.items()}
+        for level_num in self.spilled:
+            diffs[level_num] = self.read(level_num)
+        return diffs
+
+    def load_diffs(self, diffs):
+        self.clear()
+        for diff in diffs.values():
+            self.spill(diff)
+
+    def clear(self):
+        self.levels.clear()
+        self.spilled.clear()
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+
+class LevelPregenerator:
+    # builds the next level on a worker thread while the current one is played
+    def __init__(self):
+        self.thread = None
+        self.result = None
+
+    def start(self, level_num, seed):
+        self.result = None
+        self.thread = threading.Thread(target=self.run, args=(level_num, seed), daemon=True)
+        self.thread.start()
+
+    def run(self, level_num, seed):
+        self.result = ((level_num, seed), make_map(level_num, seed))
+
+    def take(self, level_num, seed):
+        result = self.result
+        self.result = None
+
+        if result is not None and result[0] == (level_num, seed):
+            return result[1]
+
+        # the worker isn't finished yet: build it here instead, the seed makes both paths agree
+        return make_map(level_num, seed)
+
+
+class TcodFov:
+    # libtcod's algorithms, run on a plain array so no tcod map has to exist
+    def compute(self, transparent, x, y, radius, light_walls, algorithm):
+        return tcod.map.compute_fov(transparent, (x, y), radius, light_walls, algorithm)
+
+
+class NumpyFov:
+    # symmetric shadowcasting (Albert Ford's), one row of a quadrant at a time as array operations;
+    # there is only the one algorithm, so the algorithm argument is ignored
+    # (col_dx, col_dy, row_dx, row_dy) for north, south, east, west
+    QUADRANTS = ((1, 0, 0, -1), (1, 0, 0, 1), (0, 1, 1, 0), (0, 1, -1, 0))
+
+    def compute(self, transparent, x, y, radius, light_walls, algorithm):
+        (w, h) = transparent.shape
+        visible = np.zeros((w, h), dtype=bool)
+        visible[x, y] = True
+
+        for quadrant in self.QUADRANTS:
+            self.scan_quadrant(transparent, visible, x, y, radius, quadrant)
+
+        if radius > 0:
+            # nothing past the radius was scanned, so only the square around the origin needs trimming
+            (x1, y1) = (max(0, x - radius), max(0, y - radius))
+            xs = np.arange(x1, min(w, x + radius + 1))[:, None] - x
+            ys = np.arange(y1, min(h, y + radius + 1))[None, :] - y
+            visible[x1:x1 + len(xs), y1:y1 + ys.shape[1]] &= xs * xs + ys * ys <= radius * radius
+
+        if not light_walls:
+            visible &= transparent
+            visible[x, y] = True
+
+        return visible
+
+    def scan_quadrant(self, transparent, visible, ox, oy, radius, quadrant):
+        (w, h) = transparent.shape
+        (col_dx, col_dy, row_dx, row_dy) = quadrant
+
+        # slopes are fractions kept as (numerator, denominator) so the rounding at ties is exact
+        rows = [(1, (-1, 1), (1, 1))]
+        while rows:
+            (depth, (start_n, start_d), (end_n, end_d)) = rows.pop()
+            if radius > 0 and depth > radius:
+                continue
+
+            min_col = (2 * depth * start_n + start_d) // (2 * start_d) # round half up
+            max_col = -((end_d - 2 * depth * end_n) // (2 * end_d)) # round half down
+            if min_col > max_col:
+                continue
+
+            cols = np.arange(min_col, max_col + 1)
+            xs = ox + cols * col_dx + depth * row_dx
+            ys = oy + cols * col_dy + depth * row_dy
+
+            # anything off the map counts as a wall that is never shown
+            inside = (xs >= 0) & (xs < w) & (ys >= 0) & (ys < h)
+            wall = np.ones(len(cols), dtype=bool)
+            wall[inside] = ~transparent[xs[inside], ys[inside]]
+
+            symmetric = (cols * start_d >= depth * start_n) & (cols * end_d <= depth * end_n)
+            shown = inside & (wall | symmetric)
+            visible[xs[shown], ys[shown]] = True
+
+            # every run of floor tiles continues as a narrower row one step further out
+            floor = np.concatenate(([False], ~wall, [False]))
+            edges = np.flatnonzero(floor[1:] != floor[:-1])
+            for (first, last) in zip(edges[::2], edges[1::2] - 1):
+                start = (start_n, start_d) if first == 0 else (2 * int(cols[first]) - 1, 2 * depth)
+                end = (end_n, end_d) if last == len(cols) - 1 else (2 * int(cols[last]) + 1, 2 * depth)
+                rows.append((depth + 1, start, end))
+
+
+FOV_BACKENDS = {'tcod': TcodFov(), 'numpy': NumpyFov()}
+
+
+class FovCache:
+    # recent FOV masks by (x, y, radius, algorithm, map version), least recently used dropped first
+    def __init__(self, capacity=FOV_CACHE_SIZE):
+        self.capacity = capacity
+        self.masks = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        mask = self.masks.get(key)
+        if mask is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.masks.move_to_end(key)
+        return mask
+
+    def put(self, key, mask):
+        self.masks[key] = mask
+        self.masks.move_to_end(key)
+
+        while len(self.masks) > self.capacity:
+            self.masks.popitem(last=False)
+
+    def clear(self):
+        self.masks.clear()
+
+
+class LightSource:
+    # component: a torch on a wall, a glowing monster, the player's own torch
+    def __init__(self, radius, brightness=1.0):
+        self.radius = radius
+        self.brightness = brightness
+
+
+class LightingMap:
+    # light intensity per tile, summed over every light; each light's patch is only redone when it
+    # moves or a tile in its reach changes
+    def __init__(self, level_map):
+        self.map = level_map
+        self.intensity = np.zeros((level_map.width, level_map.height), dtype=np.float32)
+        self.patches = {} # light -> (its position and settings, x1, y1, patch added at [x1:, y1:])
+        self.stale = set()
+
+    def update(self, lights):
+        # returns whether the intensity changed
+        changed = False
+
+        for light in set(self.patches) - set(lights):
+            self.remove(light)
+            changed = True
+
+        for light in lights:
+            key = (light.owner.x, light.owner.y, light.radius, light.brightness)
+            patch = self.patches.get(light)
+            if patch is None or patch[0] != key or light in self.stale:
+                if patch is not None:
+                    self.remove(light)
+                self.add(light, key)
+                changed = True
+
+        self.stale.clear()
+        return changed
+
+    def add(self, light, key):
+        (x, y, radius, brightness) = key
+        if radius == 0:
+            # unlimited, like an FOV radius of 0
+            (x1, y1, x2, y2) = (0, 0, self.map.width, self.map.height)
+        else:
+            (x1, y1) = (max(0, x - radius), max(0, y - radius))
+            (x2, y2) = (min(self.map.width, x + radius + 1), min(self.map.height, y + radius + 1))
+
+        # the player's torch sees exactly what the player sees, so its mask is usually in the FOV cache already
+        lit = fov_cache.get(fov_cache_key(self.map, x, y, radius))
+        if lit is not None:
+            lit = lit[x1:x2, y1:y2]
+        else:
+            # light can't leave the square around it and come back, so the FOV only needs that window
+            transparent = ~self.map.block_sight[x1:x2, y1:y2]
+            lit = FOV_BACKENDS[FOV_BACKEND].compute(transparent, x - x1, y - y1, radius, True, FOV_ALGO)
+
+        if radius == 0:
+            # no edge to fade towards: everything the light reaches is fully lit
+            patch = lit * brightness
+        else:
+            dx = np.arange(x1, x2)[:, None] - x
+            dy = np.arange(y1, y2)[None, :] - y
+            patch = lit * (brightness * (1.0 - (dx * dx + dy * dy) / float((radius + 1) ** 2)))
+
+        self.intensity[x1:x2, y1:y2] += patch
+        self.patches[light] = (key, x1, y1, patch)
+
+    def remove(self, light):
+        (key, x1, y1, patch) = self.patches.pop(light)
+        (w, h) = patch.shape
+        self.intensity[x1:x1 + w, y1:y1 + h] -= patch
+
+    def tiles_changed(self, index):
+        changed = np.zeros(self.intensity.shape, dtype=bool)
+        changed[index] = True
 
-    objects = [player]
+        for (light, (key, x1, y1, patch)) in self.patches.items():
+            (w, h) = patch.shape
+            if changed[x1:x1 + w, y1:y1 + h].any():
+                self.stale.add(light)
 
-    map = [ [Tile(True) for y in range(MAP_HEIGHT)] for x in range(MAP_WIDTH) ]
+    def levels(self):
+        # 0 (dark) to LIGHT_LEVELS (fully lit) per tile
+        return np.rint(np.clip(self.intensity, 0.0, 1.0) * LIGHT_LEVELS).astype(np.uint8)
+
+
+def make_map(level_num, seed, target_rooms=None, generator=None):
+    if generator is None:
+        generator = DUNGEON_GENERATOR
+
+    if generator == 'caves':
+        return make_cave_map(level_num, seed)
+
+    # every draw comes from the level's own RNG, never from the shared stream
+    rng = tcod.random_new_from_seed(seed)
+
+    level_map = TileGrid(MAP_WIDTH, MAP_HEIGHT)
+    level_objects = []
 
     rooms = []
+    room_index = RoomIndex()
     num_rooms = 0
 
-    for r in range(MAX_ROOMS):
-        w = tcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
-        h = tcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+    # MAX_ROOMS tries by default; with a target, keep trying until that many rooms fit
+    max_attempts = MAX_ROOMS if target_rooms is None else MAX_ROOM_ATTEMPTS
+
+    for r in range(max_attempts):
+        if target_rooms is not None and num_rooms >= target_rooms:
+            break
+
+        w = tcod.random_get_int(rng, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+        h = tcod.random_get_int(rng, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
         # random position without going out of the boundaries of the map
-        x = tcod.random_get_int(0, 0, MAP_WIDTH - w - 1)
-        y = tcod.random_get_int(0, 0, MAP_HEIGHT - h - 1)
+        x = tcod.random_get_int(rng, 0, MAP_WIDTH - w - 1)
+        y = tcod.random_get_int(rng, 0, MAP_HEIGHT - h - 1)
 
         new_room = Rect(x, y, w, h)
 
-        failed = False
-        for other_room in rooms:
-            if new_room.intersect(other_room):
-                failed = True
-                break
-
-        if not failed:
+        if not room_index.intersects(new_room):
 
-            create_room(new_room)
+            create_room(level_map, new_room)
 
 
             (new_x, new_y) = new_room.center()
-            #room_no = Object(new_x, new_y, chr(65 + num_rooms), 'room number', tcod.white, blocks=False)
-            #objects.insert(0, room_no)
-            #room_no.send_to_back()
 
             if num_rooms == 0:
-                player.x = new_x
-                player.y = new_y
+                start = (new_x, new_y)
 
             else:
                 (prev_x, prev_y) = rooms[num_rooms-1].center()
 
-                if tcod.random_get_int(0, 0, 1) == 1:
-                    create_h_tunnel(prev_x, new_x, prev_y)
-                    create_v_tunnel(prev_y, new_y, new_x)
-                else:
-                    create_v_tunnel(prev_y, new_y, prev_x)
-                    create_h_tunnel(prev_x, new_x, new_y)
+                # L-shaped corridor, horizontal or vertical leg first
+                horizontal_first = tcod.random_get_int(rng, 0, 1) == 1
+                level_map.carve_l(prev_x, prev_y, new_x, new_y, horizontal_first)
 
-                place_objects(new_room)
+                place_objects(level_map, level_objects, new_room, level_num, rng)
 
 
             rooms.append(new_room)
+            room_index.add(new_room)
             num_rooms += 1
 
+    return finish_level(level_num, seed, level_map, level_objects, start, (new_x, new_y))
+
+def make_cave_map(level_num, seed):
+    rng = tcod.random_new_from_seed(seed)
+    # the noise needs one draw per tile, so it comes from a NumPy generator seeded by the level's RNG
+    noise = np.random.default_rng(tcod.random_get_int(rng, 0, LEVEL_SEED_MAX))
+
+    walls = noise.random((MAP_WIDTH, MAP_HEIGHT)) < CAVE_FILL_PROBABILITY
+    for i in range(CAVE_SMOOTHING_PASSES):
+        walls = smooth_cave(walls)
+
+    open_tiles = largest_region(~walls)
+    if not open_tiles.any():
+        open_tiles[MAP_WIDTH // 2 - 2:MAP_WIDTH // 2 + 3, MAP_HEIGHT // 2 - 2:MAP_HEIGHT // 2 + 3] = True
+
+    level_map = TileGrid(MAP_WIDTH, MAP_HEIGHT)
+    level_map.carve_mask(open_tiles)
+    level_objects = []
+
+    # no rooms in a cave: monsters and items go into small areas around random open tiles
+    (xs, ys) = np.nonzero(open_tiles)
+    picks = noise.choice(len(xs), size=min(CAVE_SPAWN_AREAS, len(xs)), replace=False)
+    centers = [(int(xs[i]), int(ys[i])) for i in picks]
+
+    # the player starts on centers[0], so like the first room that spot stays empty
+    start = Rect(centers[0][0], centers[0][1], 0, 0)
+    half = CAVE_SPAWN_AREA_SIZE // 2
+    for (x, y) in centers[1:]:
+        area = Rect(max(0, x - half), max(0, y - half), CAVE_SPAWN_AREA_SIZE, CAVE_SPAWN_AREA_SIZE)
+        area.x2 = min(area.x2, MAP_WIDTH - 1)
+        area.y2 = min(area.y2, MAP_HEIGHT - 1)
+        if not area.intersect(start):
+            place_objects(level_map, level_objects, area, level_num, rng)
+
+    return finish_level(level_num, seed, level_map, level_objects, centers[0], centers[-1])
+
+def smooth_cave(walls):
+    # one cellular-automata pass: count the 8 neighbours of every tile at once from shifted slices
+    (w, h) = walls.shape
+    padded = np.ones((w + 2, h + 2), dtype=np.uint8)
+    padded[1:-1, 1:-1] = walls
+
+    neighbours = np.zeros((w, h), dtype=np.uint8)
+    for dx in (0, 1, 2):
+        for dy in (0, 1, 2):
+            if dx != 1 or dy != 1:
+                neighbours += padded[dx:dx + w, dy:dy + h]
+
+    walls = (neighbours >= 5) | (walls & (neighbours >= 4))
+    walls[0, :] = walls[-1, :] = True
+    walls[:, 0] = walls[:, -1] = True
+    return walls
+
+def largest_region(open_tiles):
+    # 4-connected flood fill, done on vertical runs of open tiles instead of tile by tile
+    (w, h) = open_tiles.shape
+    flat = open_tiles.ravel()
+
+    previous = np.zeros_like(flat)
+    previous[1:] = flat[:-1]
+    previous[::h] = False # every column starts new runs
+    run_ids = (np.cumsum(flat & ~previous) * flat).reshape(w, h)
+
+    num_runs = int(run_ids.max())
+    if num_runs == 0:
+        return open_tiles.copy()
+
+    # runs touching across neighbouring columns belong to the same region
+    touching = open_tiles[:-1] & open_tiles[1:]
+    pairs = np.unique(run_ids[:-1][touching].astype(np.int64) * (num_runs + 1) + run_ids[1:][touching])
+    (a, b) = np.divmod(pairs, num_runs + 1)
+
+    # hook every region onto its smallest touching label, then shortcut the chains; a few rounds settle it
+    labels = np.arange(num_runs + 1)
+    while True:
+        lowest = np.minimum(labels[a], labels[b])
+        hooked = labels.copy()
+        np.minimum.at(hooked, labels[a], lowest)
+        np.minimum.at(hooked, labels[b], lowest)
+        while True:
+            jumped = hooked[hooked]
+            if np.array_equal(jumped, hooked):
+                break
+            hooked = jumped
+        if np.array_equal(hooked, labels):
+            break
+        labels = hooked
+
+    regions = labels[run_ids]
+
+    sizes = np.bincount(regions[open_tiles])
+    return open_tiles & (regions == sizes.argmax())
+
+def finish_level(level_num, seed, level_map, level_objects, start, stairs_position):
+    (new_x, new_y) = stairs_position
+
     stairs = Object(new_x, new_y, '<', "stairs", tcod.white, always_visible=True)
-    objects.append(stairs)
-    stairs.send_to_back()
+    level_objects.append(stairs)
+
+    upstairs = None
+    if level_num > 1:
+        upstairs = Object(start[0], start[1], '>', "upstairs", tcod.white, always_visible=True)
+        level_objects.append(upstairs)
+
+    for (spawn_id, obj) in enumerate(level_objects):
+        obj.spawn_id = spawn_id
+
+    level_map.generated_version = level_map.version
+    return Level(level_num, seed, level_map, level_objects, stairs, upstairs, start)
+
+def level_seed_for(level_num):
+    return (game_seed * 1000003 + level_num * 7919) & LEVEL_SEED_MAX
+
+def level_diff(level):
+    # what play changed since make_map(): explored tiles, changed terrain, where the spawned objects are now
+    # (missing = picked up, hp None = killed) and anything brought in from elsewhere
+    present = {}
+    extra = []
+    for obj in level.objects:
+        if obj.spawn_id is None:
+            extra.append(obj)
+        else:
+            present[obj.spawn_id] = (obj.x, obj.y, obj.fighter.hp if obj.fighter else None)
+
+    return {
+        'dungeon_level': level.dungeon_level,
+        'seed': level.seed,
+        'explored': level.map.explored_bits.tobytes(),
+        'terrain': terrain_diff(level),
+        'present': present,
+        'extra': extra,
+    }
+
+def terrain_diff(level):
+    # tiles changed by set_type() since generation, as flat [x, y] indices and their new flags
+    # (type ids of 'custom' kinds aren't the same in the next process)
+    level_map = level.map
+    if level_map.version == level_map.generated_version:
+        return None
+
+    generated = make_map(level.dungeon_level, level.seed).map.types
+    cells = np.flatnonzero(level_map.types != generated).astype(np.int32)
+    return (cells.tobytes(), level_map.blocked.ravel()[cells].tobytes(), level_map.block_sight.ravel()[cells].tobytes())
+
+def restore_level(diff):
+    level = make_map(diff['dungeon_level'], diff['seed'])
+
+    level.map.explored_bits[...] = np.frombuffer(diff['explored'], dtype=np.uint8)
+
+    if diff.get('terrain') is not None:
+        (cells, blocked, block_sight) = diff['terrain']
+        cells = np.unravel_index(np.frombuffer(cells, dtype=np.int32), level.map.types.shape)
+        types = tile_types_for(np.frombuffer(blocked, dtype=bool), np.frombuffer(block_sight, dtype=bool))
+        level.map.set_type(cells, types)
+
+    level_objects = []
+    for obj in level.objects:
+        state = diff['present'].get(obj.spawn_id)
+        if state is None:
+            continue
+
+        (obj.x, obj.y, hp) = state
+        if obj.fighter and hp is None:
+            make_corpse(obj)
+            obj.layer = LAYER_CORPSE
+            level_objects.append(obj)
+        else:
+            if obj.fighter:
+                obj.fighter.hp = hp
+            level_objects.append(obj)
+
+    level.objects = level_objects + diff['extra']
+    return level
 
-def create_room(room):
-    global map
+def current_level():
+    level_objects = [obj for obj in objects if obj != player]
+    return Level(dungeon_level, level_seed, map, level_objects, stairs, upstairs, None)
 
-    for x in range(room.x1 + 1, room.x2):
-        for y in range(room.y1 + 1, room.y2):
-            map[x][y].blocked = False
-            map[x][y].block_sight = False
+def enter_level(level, x, y):
+    global map, objects, stairs, upstairs, level_seed
 
-def create_h_tunnel(x1, x2, y): # 가로
-    global map
+    map = level.map
+    objects = ObjectLayers([player] + level.objects)
+    stairs = level.stairs
+    upstairs = level.upstairs
+    level_seed = level.seed
+    (player.x, player.y) = (x, y)
 
-    for x in range(min(x1, x2), max(x1, x2) + 1):
-        map[x][y].blocked = False
-        map[x][y].block_sight = False
+    if dungeon_level + 1 not in level_store:
+        pregenerator.start(dungeon_level + 1, level_seed_for(dungeon_level + 1))
 
-def create_v_tunnel(y1, y2, x): # 세로
-    global map
+def leave_level():
+    map.on_change = None
+    level_store.put(current_level())
 
-    for y in range(min(y1, y2), max(y1, y2) + 1):
-        map[x][y].blocked = False
-        map[x][y].block_sight = False
+def create_room(level_map, room):
+    level_map.carve_rect(room.x1 + 1, room.y1 + 1, room.x2, room.y2)
 
-def place_objects(room):
+def create_h_tunnel(level_map, x1, x2, y): # 가로
+    level_map.carve_h_line(x1, x2, y)
 
-    max_monsters = from_dungeon_level([[2, 1], [3, 4], [5, 6]])
+def create_v_tunnel(level_map, y1, y2, x): # 세로
+    level_map.carve_v_line(y1, y2, x)
+
+def place_objects(level_map, level_objects, room, level_num, rng):
+
+    max_monsters = from_dungeon_level([[2, 1], [3, 4], [5, 6]], level_num)
 
     monster_chances = {}
     monster_chances["orc"] = 80
-    monster_chances["troll"] = from_dungeon_level([[15, 3], [30, 5], [60, 7]])
+    monster_chances["troll"] = from_dungeon_level([[15, 3], [30, 5], [60, 7]], level_num)
 
     for i in range(0, max_monsters):
-        x = tcod.random_get_int(0, room.x1 + 1, room.x2 - 1)
-        y = tcod.random_get_int(0, room.y1 + 1, room.y2 - 1)
+        x = tcod.random_get_int(rng, room.x1 + 1, room.x2 - 1)
+        y = tcod.random_get_int(rng, room.y1 + 1, room.y2 - 1)
 
-        if not is_blocked(x, y):
-            choice = random_choice(monster_chances)
+        if not is_blocked_in(level_map, level_objects, x, y):
+            choice = random_choice(monster_chances, rng)
 
             if choice == "orc":  # 80% chance of getting an orc
                 fighter_component = Fighter(hp=20, defense=0, power=4, xp=35, death_function=monster_death)
@@ -409,25 +1150,25 @@ def place_objects(room):
                 ai_component = BasicMonster()
                 monster = Object(x, y, 'T', 'troll', tcod.darker_green, blocks=True, fighter=fighter_component, ai=ai_component)
 
-            objects.append(monster)
+            level_objects.append(monster)
 
-    max_items = from_dungeon_level([[1, 1], [2, 4]])
+    max_items = from_dungeon_level([[1, 1], [2, 4]], level_num)
 
     item_chances = {} # {'heal': 70, 'lightning': 10, 'fireball': 10, 'confuse': 10}
 
     item_chances["heal"] = 35
-    item_chances['lightning'] = from_dungeon_level([[25, 4]])
-    item_chances['fireball'] = from_dungeon_level([[25, 6]])
-    item_chances['confuse'] = from_dungeon_level([[10, 2]])
-    item_chances["sword"] = from_dungeon_level([[5, 4]])
-    item_chances["shield"] = from_dungeon_level([[15, 8]])
+    item_chances['lightning'] = from_dungeon_level([[25, 4]], level_num)
+    item_chances['fireball'] = from_dungeon_level([[25, 6]], level_num)
+    item_chances['confuse'] = from_dungeon_level([[10, 2]], level_num)
+    item_chances["sword"] = from_dungeon_level([[5, 4]], level_num)
+    item_chances["shield"] = from_dungeon_level([[15, 8]], level_num)
 
     for i in range(0, max_items):
-        x = tcod.random_get_int(0, room.x1 + 1, room.x2 - 1)
-        y = tcod.random_get_int(0, room.y1 + 1, room.y2 - 1)
+        x = tcod.random_get_int(rng, room.x1 + 1, room.x2 - 1)
+        y = tcod.random_get_int(rng, room.y1 + 1, room.y2 - 1)
 
-        if not is_blocked(x, y):
-            choice = random_choice(item_chances)
+        if not is_blocked_in(level_map, level_objects, x, y):
+            choice = random_choice(item_chances, rng)
 
             if choice == 'heal':
                 item_component = Item(use_function=cast_heal)
@@ -453,15 +1194,17 @@ def place_objects(room):
                 equipment_component = Equipment(slot='left hand', defense_bonus=1)
                 item = Object(x, y, '[', 'shield', tcod.darker_orange, equipment=equipment_component)
 
-            objects.append(item)
-            item.send_to_back()
+            level_objects.append(item)
 
 
 def is_blocked(x, y):
-    if map[x][y].blocked:
+    return is_blocked_in(map, objects, x, y)
+
+def is_blocked_in(level_map, level_objects, x, y):
+    if level_map.blocked[x, y]:
         return True
 
-    for object in objects:
+    for object in level_objects:
         if object.blocks and object.x == x and object.y == y:
             return True
 
@@ -478,6 +1221,10 @@ def player_death(player):
 def monster_death(monster):
 
     message('The ' + monster.name.capitalize() + ' is dead! You gain ' + str(monster.fighter.xp) + ' experience points.', tcod.orange)
+    make_corpse(monster)
+    objects.set_layer(monster, LAYER_CORPSE)
+
+def make_corpse(monster):
     monster.char = '%'
     monster.color = tcod.dark_red
     monster.blocks = False
@@ -485,8 +1232,6 @@ def monster_death(monster):
     monster.ai = None
     monster.name = 'remains of ' + monster.name
 
-    monster.send_to_back()
-
 def cast_heal():
     if player.fighter.hp == player.fighter.max_hp:
         message("you are already at full health.", tcod.red)
@@ -558,8 +1303,8 @@ def target_tile(max_range=None):
     global key, mouse
 
     while True:
-        tcod.console_flush()
-        tcod.sys_check_for_event(tcod.EVENT_KEY | tcod.EVENT_MOUSE, key, mouse)
+        backend.flush()
+        backend.check_for_event(tcod.EVENT_KEY | tcod.EVENT_MOUSE, key, mouse)
         render_all()
 
         (x, y) = (mouse.cx, mouse.cy)
@@ -601,17 +1346,193 @@ def inventory_menu(header):
 
     return inventory[index].item
 
-def menu(header, options, width):
-    if len(options) > 26: raise ValueError('Cannot have a menu with more than 26 options.')
+class ConsolePool:
+    # off-screen consoles by size, reused from menu to menu instead of allocating one each time
+    def __init__(self, capacity=MENU_CONSOLE_POOL_SIZE):
+        self.capacity = capacity
+        self.consoles = collections.OrderedDict() # least recently used first
+
+    def get(self, width, height):
+        window = self.consoles.pop((width, height), None)
+        if window is None:
+            window = tcod.console_new(width, height)
+
+        self.consoles[(width, height)] = window
+        while len(self.consoles) > self.capacity:
+            self.consoles.popitem(last=False)
+
+        tcod.console_set_default_background(window, tcod.black)
+        tcod.console_clear(window)
+        return window
+
+
+class FrameProfiler:
+    # per-phase frame timings, switched on and off with F3; while off every call returns right away
+    def __init__(self, window=PROFILE_WINDOW, log_path=PROFILE_LOG):
+        self.enabled = False
+        self.log_path = log_path
+        self.log = None
+        self.frame = 0
+        self.phases = collections.OrderedDict() # phase -> seconds spent in it this frame
+        self.busy_times = collections.deque(maxlen=window) # frame time without waiting for input
+        self.frame_times = collections.deque(maxlen=window) # wall-clock time between frames
+        self.frame_start = None
+        self.last_mark = None
+        self.report = None
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        self.frame_start = None
+        self.busy_times.clear()
+        self.frame_times.clear()
+        self.report = None
+
+        if self.enabled:
+            self.log = open(self.log_path, 'a')
+        elif self.log is not None:
+            self.log.close()
+            self.log = None
+
+    def start_frame(self):
+        if not self.enabled:
+            return
+
+        now = time.perf_counter()
+        if self.frame_start is not None:
+            self.end_frame(now)
+
+        self.frame_start = self.last_mark = now
+        self.phases.clear()
+
+    def mark(self, phase):
+        # everything since the previous mark is charged to this phase
+        if not self.enabled or self.frame_start is None:
+            return
+
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last_mark
+        self.last_mark = now
+
+    def end_frame(self, now):
+        self.frame += 1
+        busy = sum(seconds for (phase, seconds) in self.phases.items() if phase != 'input')
+        self.busy_times.append(busy)
+        self.frame_times.append(now - self.frame_start)
+
+        busy_ms = np.array(self.busy_times) * 1000.0
+        fps = len(self.frame_times) / sum(self.frame_times)
+        self.report = (['FPS ' + format(fps, '.1f'),
+                        'p50 ' + format(np.percentile(busy_ms, 50), '.2f') + ' ms',
+                        'p99 ' + format(np.percentile(busy_ms, 99), '.2f') + ' ms'] +
+                       [phase + ' ' + format(seconds * 1000.0, '.2f') for (phase, seconds) in self.phases.items()])
+
+        self.log.write('frame ' + str(self.frame) + ': ' + ', '.join(self.report) + '\n')
+
+    def draw(self, console):
+        if not self.enabled or self.report is None:
+            return
+
+        tcod.console_set_default_foreground(console, tcod.light_yellow)
+        for (y, line) in enumerate(self.report):
+            tcod.console_print_ex(console, SCREEN_WIDTH - 1, y, tcod.BKGND_NONE, tcod.RIGHT, line)
+
+
+class TcodBackend:
+    # the real window
+    def init(self):
+        tcod.console_set_custom_font('/Users/adun/Desktop/RoguelikeTutorial/arial10x10.png', tcod.FONT_TYPE_GREYSCALE | tcod.FONT_LAYOUT_TCOD)
+
+        root = tcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, WINDOW_TITLE, FULL_SCREEN)
+
+        tcod.sys_set_fps(LIMIT_FPS)
+
+        return root
+
+    def flush(self):
+        tcod.console_flush()
+
+    def check_for_event(self, mask, key, mouse):
+        return tcod.sys_check_for_event(mask, key, mouse)
+
+    def wait_for_event(self, mask, key, mouse):
+        return tcod.sys_wait_for_event(mask, key, mouse, False)
+
+    def wait_for_keypress(self):
+        return tcod.console_wait_for_keypress(True)
+
+    def is_window_closed(self):
+        return tcod.console_is_window_closed()
+
+    def toggle_fullscreen(self):
+        tcod.console_set_fullscreen(not tcod.console_is_fullscreen())
+
+    def load_image(self, path):
+        return tcod.image_load(path)
+
+
+class HeadlessBackend:
+    # no window: input comes from a script of keys ('g', 'up', 'escape', ...) and the last max_frames flushed
+    # root consoles are kept as (ch, fg, bg) arrays; once the script runs out it presses escape and closes
+    def __init__(self, keys=(), max_frames=HEADLESS_FRAMES):
+        self.keys = collections.deque(keys)
+        self.frames = collections.deque(maxlen=max_frames)
+        self.closed = False
+        self.root = None
+
+    def init(self):
+        self.root = tcod.console.Console(SCREEN_WIDTH, SCREEN_HEIGHT)
+        return self.root
+
+    def flush(self):
+        self.frames.append((self.root.ch.copy(), self.root.fg.copy(), self.root.bg.copy()))
+
+    def next_key(self):
+        if not self.keys:
+            self.closed = True
+            return tcod.Key(vk=tcod.KEY_ESCAPE, pressed=True)
+
+        name = self.keys.popleft()
+        if len(name) == 1:
+            return tcod.Key(vk=tcod.KEY_CHAR, c=ord(name), pressed=True)
+        return tcod.Key(vk=getattr(tcod, 'KEY_' + name.upper()), pressed=True)
+
+    def check_for_event(self, mask, key, mouse):
+        scripted = self.next_key()
+        (key.vk, key.c, key.pressed, key.lalt) = (scripted.vk, scripted.c, scripted.pressed, scripted.lalt)
+        return tcod.EVENT_KEY_PRESS
+
+    def wait_for_event(self, mask, key, mouse):
+        return self.check_for_event(mask, key, mouse)
+
+    def wait_for_keypress(self):
+        return self.next_key()
+
+    def is_window_closed(self):
+        return self.closed
 
-    header_height = tcod.console_get_height_rect(con, 0, 0, width, SCREEN_HEIGHT, header)
+    def toggle_fullscreen(self):
+        pass
 
+    def load_image(self, path):
+        return None
+
+
+@functools.lru_cache(maxsize=64)
+def header_height_for(header, width):
+    # lines the header wraps to; the same few headers come back all the time
     if header == '':
-        header_height = 0
+        return 0
+
+    return tcod.console_get_height_rect(con, 0, 0, width, SCREEN_HEIGHT, header)
+
+def menu(header, options, width):
+    if len(options) > 26: raise ValueError('Cannot have a menu with more than 26 options.')
+
+    header_height = header_height_for(header, width)
 
     height = len(options) + header_height + 2
 
-    window = tcod.console_new(SCREEN_WIDTH, SCREEN_HEIGHT)
+    window = menu_consoles.get(width, height)
 
     tcod.console_set_default_foreground(window, tcod.white)
     tcod.console_print_rect_ex(window, 0, 1, width, height, tcod.BKGND_NONE, tcod.LEFT, header)
@@ -628,13 +1549,13 @@ def menu(header, options, width):
     y = int(SCREEN_HEIGHT /2 - height / 2)
 
 
-    tcod.console_blit(window, 0, 0, width, height, 0, x, y - 3, 1.0, 0.7)
+    tcod.console_blit(window, 0, 0, width, height, root, x, y - 3, 1.0, 0.7)
 
-    tcod.console_flush()
-    key = tcod.console_wait_for_keypress(True)
+    backend.flush()
+    key = backend.wait_for_keypress()
 
     if key.vk == tcod.KEY_ENTER and key.lalt:
-        tcod.console_set_fullscreen(not tcod.console_is_fullscreen())
+        backend.toggle_fullscreen()
 
     index = key.c - ord('a')
     if index >= 0 and index < len(options):
@@ -646,10 +1567,11 @@ def msgbox(text, width=50):
     menu(text, [], width)
 
 def main_menu():
-    img = tcod.image_load("/Users/adun/Desktop/RoguelikeTutorial/princess.png") # 160 * 100
+    img = backend.load_image("/Users/adun/Desktop/RoguelikeTutorial/princess.png") # 160 * 100
 
-    while not tcod.console_is_window_closed():
-        tcod.image_blit_2x(img, 0, 0, 0)
+    while not backend.is_window_closed():
+        if img is not None:
+            tcod.image_blit_2x(img, root, 0, 0)
 
         choice = menu("", ["Play a new game, ", "Continue last game", "Quit"], 24)
 
@@ -691,9 +1613,9 @@ def check_level_up():
             player.fighter.base_defense += 1
 
 
-def random_choice_index(chances):
+def random_choice_index(chances, rng=0):
 
-    dice = tcod.random_get_int(0, 1, sum(chances))
+    dice = tcod.random_get_int(rng, 1, sum(chances))
 
     running_sum = 0
     choice = 0
@@ -706,16 +1628,16 @@ def random_choice_index(chances):
 
         choice += 1
 
-def random_choice(chances_dict):
+def random_choice(chances_dict, rng=0):
     chances = chances_dict.values()
     strings = list(chances_dict.keys())
 
-    return strings[random_choice_index(chances)]
+    return strings[random_choice_index(chances, rng)]
 
 
-def from_dungeon_level(table):
+def from_dungeon_level(table, level_num):
     for (value, level) in reversed(table):
-        if dungeon_level >= level:
+        if level_num >= level:
             return value
 
     return 0
@@ -740,92 +1662,115 @@ def get_all_equipped(obj):
         return []
 
 
+def draw_objects():
+    global drawn_cells
+
+    # what every tile should show now; objects come bottom layer first, so the top one wins
+    cells = {}
+    for object in objects:
+        glyph = object.glyph()
+        if glyph is not None:
+            cells[(object.x, object.y)] = glyph
+
+    # only touch the tiles that differ from the last frame: something moved, died, was picked up
+    # or went out of sight
+    for (x, y) in drawn_cells.keys() - cells.keys():
+        tcod.console_put_char(con, x, y, ' ', tcod.BKGND_NONE)
+
+    for ((x, y), (char, color)) in cells.items():
+        if drawn_cells.get((x, y)) != (char, color):
+            tcod.console_set_default_foreground(con, color)
+            tcod.console_put_char(con, x, y, char, tcod.BKGND_NONE)
+
+    drawn_cells = cells
+
 def render_all():
     global fov_map, color_dark_wall, color_light_wall
     global color_dark_ground, color_light_ground
-    global fov_recompute
+    global fov_recompute, fov_mask, light_levels, panel_key
 
-    if fov_recompute:
-        # recompute FOV if needed (the player moved or something)
+    # recompute FOV if needed (the player moved or something); before the lights, which reuse its mask
+    new_fov_mask = compute_fov() if fov_recompute else fov_mask
+    lights_changed = lighting.update([object.light for object in objects if object.light])
+
+    if fov_recompute or lights_changed:
         fov_recompute = False
-        tcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
-
-        # go through all tiles, and set their background color according to the FOV
-        for y in range(MAP_HEIGHT):
-            for x in range(MAP_WIDTH):
-                visible = tcod.map_is_in_fov(fov_map, x, y)
-                wall = map[x][y].block_sight
-                if EXPLORE_MODE:
-                    if not visible:
-                        # it's out of the player's FOV
-                        if map[x][y].explored:
-                            if wall:
-                                tcod.console_set_char_background(con, x, y, color_dark_wall, tcod.BKGND_SET)
-                            else:
-                                tcod.console_set_char_background(con, x, y, color_dark_ground, tcod.BKGND_SET)
-                    else:
-                        # it's visible
-                        if wall:
-                            tcod.console_set_char_background(con, x, y, color_light_wall, tcod.BKGND_SET)
-                        else:
-                            tcod.console_set_char_background(con, x, y, color_light_ground, tcod.BKGND_SET)
-
-                        map[x][y].explored = True
-
-                else:
-                    if not visible:
-                        # it's out of the player's FOV
-                        if wall:
-                            tcod.console_set_char_background(con, x, y, color_dark_wall, tcod.BKGND_SET)
-                        else:
-                            tcod.console_set_char_background(con, x, y, color_dark_ground, tcod.BKGND_SET)
-                    else:
-                        # it's visible
-                        if wall:
-                            tcod.console_set_char_background(con, x, y, color_light_wall, tcod.BKGND_SET)
-                        else:
-                            tcod.console_set_char_background(con, x, y, color_light_ground, tcod.BKGND_SET)
-
-    # draw all objects in the list
-    for object in objects:
-        if object != player:
-            object.draw()
+        profiler.mark('fov')
 
-    player.draw()
+        # visible tiles are shaded by how much light falls on them, the rest get the dark colors
+        new_light_levels = np.where(new_fov_mask, lighting.levels(), 0)
 
-    # blit the contents of "con" to the root console
-    tcod.console_blit(con, 0, 0, SCREEN_WIDTH, SCREEN_HEIGHT, 0, 0, 0)
+        # only tiles whose visibility or light changed need a new background, unless the console was cleared
+        if fov_mask is None:
+            changed = np.ones_like(new_fov_mask)
+        else:
+            changed = (new_fov_mask != fov_mask) | (new_light_levels != light_levels)
+        (fov_mask, light_levels) = (new_fov_mask, new_light_levels)
 
-    # GUI
-    tcod.console_set_default_background(panel, tcod.black)
-    tcod.console_clear(panel)
+        if EXPLORE_MODE:
+            map.explore(fov_mask)
+            changed &= map.explored # unexplored tiles stay black
 
-    message_y = 1
+        # pick every changed tile's background from a [wall][light level] color table at once
+        # and write them into the console
+        steps = np.linspace(0.0, 1.0, LIGHT_LEVELS + 1)[:, None]
+        (dark, light) = (np.array([color_dark_ground, color_dark_wall]), np.array([color_light_ground, color_light_wall]))
+        colors = np.rint(dark[:, None] + (light - dark)[:, None] * steps).astype(np.uint8)
 
-    for (line, color) in game_msgs:
-        tcod.console_set_default_foreground(panel, color)
-        tcod.console_print_ex(panel, MSG_X, message_y, tcod.BKGND_NONE, tcod.LEFT, line)
-        message_y += 1
+        (w, h) = (min(MAP_WIDTH, con.width), min(MAP_HEIGHT, con.height))
+        changed = changed[:w, :h]
+        walls = map.block_sight[:w, :h].astype(np.intp)
+        con.bg[:h, :w].transpose(1, 0, 2)[changed] = colors[walls[changed], light_levels[:w, :h][changed]]
+        profiler.mark('map')
 
-    tcod.console_set_default_foreground(panel, tcod.light_gray)
+    draw_objects()
+    profiler.mark('objects')
+
+    # blit the contents of "con" to the root console
+    tcod.console_blit(con, 0, 0, SCREEN_WIDTH, SCREEN_HEIGHT, root, 0, 0)
+
+    # GUI, only redrawn when something it shows changed; otherwise the last one is blitted again
     name = get_names_under_mouse()
-    tcod.console_print_ex(panel, 1, 0, tcod.BKGND_NONE, tcod.LEFT, name)
+    new_panel_key = (player.fighter.hp, player.fighter.max_hp, tuple(game_msgs), dungeon_level, name)
+    if new_panel_key != panel_key:
+        panel_key = new_panel_key
+
+        tcod.console_set_default_background(panel, tcod.black)
+        tcod.console_clear(panel)
+
+        message_y = 1
+
+        for (line, color) in game_msgs:
+            tcod.console_set_default_foreground(panel, color)
+            tcod.console_print_ex(panel, MSG_X, message_y, tcod.BKGND_NONE, tcod.LEFT, line)
+            message_y += 1
 
-    tcod.console_print_ex(panel, 1, 3, tcod.BKGND_NONE, tcod.LEFT, 'Dungeon level ' + str(dungeon_level))
+        tcod.console_set_default_foreground(panel, tcod.light_gray)
+        tcod.console_print_ex(panel, 1, 0, tcod.BKGND_NONE, tcod.LEFT, name)
 
-    render_bar(1, 1, BAR_WIDTH, "HP", player.fighter.hp, player.fighter.max_hp, tcod.light_red, tcod.darker_red)
-    tcod.console_blit(panel, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0, PANEL_Y)
+        tcod.console_print_ex(panel, 1, 3, tcod.BKGND_NONE, tcod.LEFT, 'Dungeon level ' + str(dungeon_level))
+
+        render_bar(1, 1, BAR_WIDTH, "HP", player.fighter.hp, player.fighter.max_hp, tcod.light_red, tcod.darker_red)
+
+    tcod.console_blit(panel, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, root, 0, PANEL_Y)
+    profiler.mark('panel')
+
+    profiler.draw(root)
 
 
 def handle_keys():
     global key
 
     if key.vk == tcod.KEY_ENTER and key.lalt:
-        tcod.console_set_fullscreen(not tcod.console_is_fullscreen())
+        backend.toggle_fullscreen()
 
     elif key.vk == tcod.KEY_ESCAPE:
         return 'exit'  # exit game
 
+    elif key.vk == tcod.KEY_F3:
+        profiler.toggle()
+        return 'didnt-take-turn'
+
     if game_state == 'playing':
         if key.vk == tcod.KEY_UP or key.vk == tcod.KEY_KP8:
             player_move_or_attack(0, -1)
@@ -868,13 +1813,16 @@ def handle_keys():
             if key_char == 'a':
                 if stairs.x == player.x and stairs.y == player.y:
                     next_level()
+                elif upstairs is not None and upstairs.x == player.x and upstairs.y == player.y:
+                    previous_level()
 
             if key_char == 'c':
                 level_up_xp = LEVEL_UP_BASE + player.level * LEVEL_UP_FACTOR
                 msgbox(
                     'Character Information\n\nLevel: ' + str(player.level) + '\nExperience: ' + str(player.fighter.xp) +
                     '\nExperience to level up: ' + str(level_up_xp) + '\n\nMaximum HP: ' + str(player.fighter.max_hp) +
-                    '\nAttack: ' + str(player.fighter.power) + '\nDefense: ' + str(player.fighter.defense),
+                    '\nAttack: ' + str(player.fighter.power) + '\nDefense: ' + str(player.fighter.defense) +
+                    '\n\nDungeon seed: ' + str(game_seed),
                     CHARACTER_SCREEN_WIDTH)
 
             else:
@@ -905,6 +1853,18 @@ def player_move_or_attack(dx, dy):
 con = tcod.console_new(SCREEN_WIDTH, SCREEN_HEIGHT)
 
 panel = tcod.console_new(SCREEN_WIDTH, SCREEN_HEIGHT)
+panel_key = None # what the panel showed when it was last drawn
+
+menu_consoles = ConsolePool()
+
+profiler = FrameProfiler()
+
+backend = TcodBackend() # swap in a HeadlessBackend before main() to run without a window
+root = None # the root console, set by backend.init()
+
+pregenerator = LevelPregenerator()
+level_store = LevelStore()
+fov_cache = FovCache()
 
 
 
@@ -946,27 +1906,56 @@ def render_bar(x, y, total_width, name, value, maximum, bar_color, back_color):
 def next_level():
     global dungeon_level
 
+    leave_level()
     dungeon_level += 1
 
+    level = level_store.take(dungeon_level)
+    if level is not None:
+        message('You descend the stairs again.', tcod.light_violet)
+        enter_level(level, level.upstairs.x, level.upstairs.y)
+        initialize_fov()
+        return
+
     message('You take a moment to rest, and recover your strength.', tcod.light_violet)
     player.fighter.heal(player.fighter.max_hp // 2)
 
     message('After a rare moment of peace, you descend deeper into the heart of the dungeon...', tcod.red)
-    make_map()
+    level = pregenerator.take(dungeon_level, level_seed_for(dungeon_level))
+    enter_level(level, level.start[0], level.start[1])
+    initialize_fov()
+
+
+def previous_level():
+    global dungeon_level
+
+    leave_level()
+    dungeon_level -= 1
+
+    message('You climb back up the stairs.', tcod.light_violet)
+    level = level_store.take(dungeon_level)
+    enter_level(level, level.stairs.x, level.stairs.y)
     initialize_fov()
 
 
 def new_game():
-    global player, inventory, game_msgs, game_state, dungeon_level
+    global player, inventory, game_msgs, game_state, dungeon_level, game_seed
 
     dungeon_level = 1
 
     fighter_component = Fighter(hp=100, defense=1, power=4, xp=0, death_function=player_death)
-    player = Object(0, 0, '@', 'player', tcod.white, blocks=True, fighter=fighter_component)
+    player = Object(0, 0, '@', 'player', tcod.white, blocks=True, fighter=fighter_component,
+                    light=LightSource(TORCH_RADIUS), layer=LAYER_PLAYER)
 
     player.level = 1
 
-    make_map()
+    game_seed = GAME_SEED
+    if game_seed is None:
+        game_seed = tcod.random_get_int(0, 0, LEVEL_SEED_MAX)
+
+    level_store.clear()
+
+    level = make_map(dungeon_level, level_seed_for(dungeon_level))
+    enter_level(level, level.start[0], level.start[1])
     initialize_fov()
 
     inventory = []
@@ -985,87 +1974,153 @@ def new_game():
 
 
 def initialize_fov():
-    global fov_map, fov_recompute
+    global fov_map, fov_recompute, fov_mask, lighting, drawn_cells
 
     fov_recompute = True
+    fov_mask = None # the console is cleared below, so the next render repaints every tile
+    drawn_cells = {}
 
+    (blocked, block_sight) = (map.blocked, map.block_sight)
+
+    # the FOV map's arrays are [y, x], hence the transposes
     fov_map = tcod.map_new(MAP_WIDTH, MAP_HEIGHT)
-    for y in range(MAP_HEIGHT):
-        for x in range(MAP_WIDTH):
-            tcod.map_set_properties(fov_map, x, y, not map[x][y].block_sight, not map[x][y].blocked)
+    fov_map.transparent[...] = ~block_sight.T
+    fov_map.walkable[...] = ~blocked.T
+    map.on_change = update_fov_map
+    fov_cache.clear()
+    lighting = LightingMap(map)
 
     tcod.console_clear(con)
 
 
+def update_fov_map(index):
+    global fov_recompute, fov_mask
+
+    # some tiles changed kind: copy just those into the FOV map and repaint
+    fov_map.transparent.T[index] = ~map.block_sight[index]
+    fov_map.walkable.T[index] = ~map.blocked[index]
+    fov_cache.clear() # the map version changed, none of the cached masks can match again
+    lighting.tiles_changed(index)
+
+    fov_recompute = True
+    fov_mask = None
+
+def fov_cache_key(level_map, x, y, radius):
+    return (x, y, radius, FOV_ALGO, FOV_BACKEND, level_map.version)
+
+def compute_fov():
+    # stepping back onto a recent tile reuses its mask; the cached arrays are shared, don't modify them
+    key = fov_cache_key(map, player.x, player.y, TORCH_RADIUS)
+    mask = fov_cache.get(key)
+
+    if mask is None:
+        fov_backend = FOV_BACKENDS[FOV_BACKEND]
+        mask = fov_backend.compute(fov_map.transparent.T, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
+        fov_cache.put(key, mask)
+
+    # map_is_in_fov() reads the FOV map, so it has to hold the mask too
+    fov_map.fov.T[...] = mask
+
+    return mask
+
+
 def play_game():
     global key, mouse
 
     mouse = tcod.Mouse()
     key = tcod.Key()
 
-    while not tcod.console_is_window_closed():
-        tcod.sys_check_for_event(tcod.EVENT_KEY_PRESS | tcod.EVENT_MOUSE, key, mouse)
+    while not backend.is_window_closed():
+        profiler.start_frame()
 
+        # draw the state the last input led to, then wait for the next one
         render_all()
 
-
-        tcod.console_flush()
+        backend.flush()
+        profiler.mark('flush')
 
         check_level_up()
 
-
-        for object in objects:
-            object.clear()
+        wait_for_input()
+        profiler.mark('input')
 
         player_action = handle_keys()
+        profiler.mark('handle_keys')
         if player_action == 'exit':
             save_game()
+            level_store.clear()
             break
 
         if game_state == "playing" and player_action != "didnt-take-turn":
-            for object in objects:
-                if object.ai:
-                    object.ai.take_turn()
+            take_monster_turns()
+            profiler.mark('ai')
+
+def wait_for_input():
+    events = tcod.EVENT_KEY_PRESS | tcod.EVENT_MOUSE
+
+    if not TURN_BASED:
+        backend.check_for_event(events, key, mouse)
+    elif TURN_TIMEOUT is None:
+        backend.wait_for_event(events, key, mouse)
+    else:
+        # libtcod can't wait with a timeout, so poll at the frame rate until input comes or time is up
+        deadline = time.perf_counter() + TURN_TIMEOUT
+        while not backend.check_for_event(events, key, mouse) and time.perf_counter() < deadline:
+            time.sleep(1.0 / LIMIT_FPS)
+
+def take_monster_turns():
+    # one lookup for every monster: FOV is symmetric, so a monster in the player's FOV sees the player
+    actors = [object for object in objects if object.ai]
+    xs = np.array([actor.x for actor in actors], dtype=np.intp)
+    ys = np.array([actor.y for actor in actors], dtype=np.intp)
+    sees_player = fov_map.fov[ys, xs].tolist()
+
+    for (actor, sees) in zip(actors, sees_player):
+        actor.ai.take_turn(sees)
 
 def save_game():
+    # levels are saved as seed + diff and regenerated on load, never as whole maps
+    level_diffs = level_store.diffs()
+    level_diffs[dungeon_level] = level_diff(current_level())
 
     file = shelve.open("savegame", "n")
-    file["map"] = map
-    file["objects"] = objects
-    file["player_index"] = objects.index(player)
+    file['game_seed'] = game_seed
+    file['dungeon_generator'] = DUNGEON_GENERATOR
+    file['dungeon_level'] = dungeon_level
+    file['level_diffs'] = level_diffs
+    file['player'] = player
     file['inventory'] = inventory
     file['game_msgs'] = game_msgs
     file['game_state'] = game_state
-    file['stairs_index'] = objects.index(stairs)
-    file['dungeon_level'] = dungeon_level
 
     file.close()
 
 def load_game():
-    global map, objects, player, inventory, game_msgs, game_state, stairs, dungeon_level
+    global player, inventory, game_msgs, game_state, dungeon_level, game_seed, DUNGEON_GENERATOR
 
     file = shelve.open("savegame", "r")
-    map = file["map"]
-    objects = file['objects']
-    player = objects[file['player_index']]  # get index of player in objects list and access it
+    game_seed = file['game_seed']
+    DUNGEON_GENERATOR = file['dungeon_generator'] # the levels only regenerate with the generator that made them
+    dungeon_level = file['dungeon_level']
+    level_diffs = file['level_diffs']
+    player = file['player']
     inventory = file['inventory']
     game_msgs = file['game_msgs']
     game_state = file['game_state']
-    stairs = objects[file['stairs_index']]
-    dungeon_level = file['dungeon_level']
 
     file.close()
 
+    level = restore_level(level_diffs.pop(dungeon_level))
+    level_store.load_diffs(level_diffs)
+
+    enter_level(level, player.x, player.y)
     initialize_fov()
 
 
 def main():
+    global root
 
-    tcod.console_set_custom_font('/Users/adun/Desktop/RoguelikeTutorial/arial10x10.png', tcod.FONT_TYPE_GREYSCALE | tcod.FONT_LAYOUT_TCOD)
-
-    tcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, WINDOW_TITLE, FULL_SCREEN)
-
-    tcod.sys_set_fps(LIMIT_FPS)
+    root = backend.init()
 
     main_menu()
 
@@ -0,0 +1,279 @@
+# Headless benchmarks for the tutorial game, no window is opened.
+#
+#   python benchmark.py dungeon --sizes 80x43,200x200 --rooms 30,300 --levels 1,6 --output before.json
+#   python benchmark.py fov --sizes 80x43,500x500 --radii 7,20 --output fov.json
+#   python benchmark.py play --turns 500 --output play.json
+#   python benchmark.py compare before.json after.json
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+GAME_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Part 13: Adventure gear.py')
+
+FOV_ALGORITHMS = (['FOV_BASIC', 'FOV_DIAMOND', 'FOV_SHADOW'] + ['FOV_PERMISSIVE_' + str(i) for i in range(9)] +
+                  ['FOV_RESTRICTIVE', 'FOV_SYMMETRIC_SHADOWCAST'])
+
+
+def load_game_module(path=GAME_FILE):
+    # the chapter files aren't importable by name, so load it from its path
+    spec = importlib.util.spec_from_file_location('game', path)
+    game = importlib.util.module_from_spec(spec)
+    sys.modules['game'] = game # pickling the game's objects (saves, spilled levels) looks classes up here
+    spec.loader.exec_module(game)
+    return game
+
+
+def parse_sizes(text):
+    sizes = []
+    for item in text.split(','):
+        (w, h) = item.lower().split('x')
+        sizes.append((int(w), int(h)))
+    return sizes
+
+
+def parse_ints(text):
+    return [int(item) for item in text.split(',')]
+
+
+def count_objects(level):
+    monsters = sum(1 for obj in level.objects if obj.fighter)
+    items = sum(1 for obj in level.objects if obj.item)
+    return (len(level.objects), monsters, items)
+
+
+def bench_dungeon(game, generator, width, height, max_rooms, dungeon_level, repeat, seed):
+    game.DUNGEON_GENERATOR = generator
+    game.MAP_WIDTH = width
+    game.MAP_HEIGHT = height
+    game.MAX_ROOMS = max_rooms
+
+    # warm up once so the first measured level doesn't pay for imports and caches
+    game.make_map(dungeon_level, seed)
+
+    start = time.perf_counter()
+    levels = [game.make_map(dungeon_level, seed + i) for i in range(repeat)]
+    elapsed = time.perf_counter() - start
+
+    # memory is measured on its own pass, tracemalloc slows everything down
+    tracemalloc.start()
+    game.make_map(dungeon_level, seed)
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    counts = [count_objects(level) for level in levels]
+    floor = sum(int((~level.map.blocked).sum()) for level in levels)
+
+    return {
+        'generator': generator,
+        'map_width': width,
+        'map_height': height,
+        'max_rooms': max_rooms,
+        'dungeon_level': dungeon_level,
+        'repeat': repeat,
+        'seconds': elapsed,
+        'levels_per_second': repeat / elapsed if elapsed > 0 else None,
+        'ms_per_level': elapsed * 1000.0 / repeat,
+        'peak_memory_bytes': peak,
+        'objects_per_level': sum(c[0] for c in counts) / repeat,
+        'monsters_per_level': sum(c[1] for c in counts) / repeat,
+        'items_per_level': sum(c[2] for c in counts) / repeat,
+        'floor_tiles_per_level': floor / repeat,
+    }
+
+
+def run_dungeon(args):
+    game = load_game_module(args.game)
+
+    results = []
+    for generator in args.generators.split(','):
+        for (width, height) in parse_sizes(args.sizes):
+            for max_rooms in parse_ints(args.rooms):
+                for dungeon_level in parse_ints(args.levels):
+                    result = bench_dungeon(game, generator, width, height, max_rooms, dungeon_level, args.repeat, args.seed)
+                    results.append(result)
+                    print('{generator:>6} {map_width:>5}x{map_height:<5} rooms {max_rooms:>5} level {dungeon_level:>3}: '
+                          '{levels_per_second:9.1f} levels/s {ms_per_level:8.2f} ms  '
+                          'peak {peak_memory_bytes:>10} B  objects {objects_per_level:7.1f}'.format(**result))
+
+    write_results(args.output, 'dungeon', results)
+
+
+def time_fov(backend, transparent, positions, radius, algorithm):
+    start = time.perf_counter()
+    masks = [backend.compute(transparent, x, y, radius, True, algorithm) for (x, y) in positions]
+    elapsed = time.perf_counter() - start
+    return (masks, elapsed * 1000.0 / len(positions))
+
+
+def agreement(masks, reference):
+    # share of the tiles either side sees on which both agree
+    mismatched = sum(int((mask != ref).sum()) for (mask, ref) in zip(masks, reference))
+    seen = sum(int((mask | ref).sum()) for (mask, ref) in zip(masks, reference))
+    return (1.0 - mismatched / seen if seen else 1.0, mismatched / len(masks))
+
+
+def run_fov(args):
+    game = load_game_module(args.game)
+    tcod_fov = game.FOV_BACKENDS['tcod']
+    numpy_fov = game.FOV_BACKENDS['numpy']
+
+    results = []
+    for (width, height) in parse_sizes(args.sizes):
+        game.MAP_WIDTH = width
+        game.MAP_HEIGHT = height
+        level = game.make_map(1, args.seed, generator=args.generator)
+        transparent = ~level.map.block_sight
+
+        # the same random floor tiles for every backend and algorithm
+        floor = list(zip(*transparent.nonzero()))
+        step = max(1, len(floor) // args.positions)
+        positions = [(int(x), int(y)) for (x, y) in floor[::step][:args.positions]]
+
+        for radius in parse_ints(args.radii):
+            (numpy_masks, numpy_ms) = time_fov(numpy_fov, transparent, positions, radius, 0)
+
+            for name in FOV_ALGORITHMS:
+                algorithm = getattr(game.tcod.constants, name)
+                (tcod_masks, tcod_ms) = time_fov(tcod_fov, transparent, positions, radius, algorithm)
+                (share, mismatched) = agreement(numpy_masks, tcod_masks)
+
+                case = {'map_width': width, 'map_height': height, 'radius': radius, 'algorithm': algorithm,
+                        'algorithm_name': name, 'positions': len(positions)}
+                for (backend, ms, backend_share, backend_mismatched) in (('tcod', tcod_ms, 1.0, 0.0),
+                                                                          ('numpy', numpy_ms, share, mismatched)):
+                    result = dict(case, backend=backend, ms_per_fov=ms, agreement=backend_share,
+                                  mismatched_tiles_per_fov=backend_mismatched)
+                    results.append(result)
+                    print('{map_width:>5}x{map_height:<5} radius {radius:>3} {algorithm_name:<25} {backend:<6}: '
+                          '{ms_per_fov:8.3f} ms  agreement {agreement:6.1%}'.format(**result))
+
+    write_results(args.output, 'fov', results)
+
+
+PLAY_KEYS = ['up', 'down', 'left', 'right', 'home', 'pageup', 'end', 'pagedown', 'kp5', 'g', 'a']
+
+
+def run_play(args):
+    game = load_game_module(args.game)
+    game.GAME_SEED = args.seed
+
+    # a random walk through the whole game loop: main menu, new game, then random moves until escape
+    keys = random.Random(args.seed)
+    script = ['a'] + [keys.choice(PLAY_KEYS) for i in range(args.turns)]
+
+    # the game saves into the working directory when it quits
+    with tempfile.TemporaryDirectory() as directory:
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            game.backend = game.HeadlessBackend(script, max_frames=1)
+            start = time.perf_counter()
+            game.main()
+            elapsed = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+
+    result = {
+        'turns': args.turns,
+        'seconds': elapsed,
+        'ms_per_turn': elapsed * 1000.0 / args.turns,
+        'dungeon_level': game.dungeon_level,
+        'player_hp': game.player.fighter.hp,
+    }
+    print('{turns} turns: {ms_per_turn:.3f} ms per turn, ended on level {dungeon_level} '
+          'with {player_hp} hp'.format(**result))
+
+    write_results(args.output, 'play', [result])
+
+
+def write_results(path, suite, results):
+    if path is None:
+        return
+
+    report = {
+        'suite': suite,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'argv': sys.argv[1:],
+        'results': results,
+    }
+    with open(path, 'w') as file:
+        json.dump(report, file, indent=2, sort_keys=True)
+        file.write('\n')
+
+
+def case_key(result):
+    return tuple((name, value) for (name, value) in sorted(result.items())
+                 if name in ('generator', 'backend', 'map_width', 'map_height', 'max_rooms', 'dungeon_level', 'radius',
+                             'algorithm'))
+
+
+def run_compare(args):
+    with open(args.before) as file:
+        before = {case_key(result): result for result in json.load(file)['results']}
+    with open(args.after) as file:
+        after = {case_key(result): result for result in json.load(file)['results']}
+
+    for (key, new) in after.items():
+        old = before.get(key)
+        if old is None:
+            continue
+
+        case = ' '.join(str(name) + '=' + str(value) for (name, value) in key)
+        changes = []
+        for metric in args.metrics.split(','):
+            if old.get(metric) and new.get(metric) is not None:
+                changes.append(metric + ' x' + format(new[metric] / old[metric], '.2f'))
+        print(case + ': ' + ', '.join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless benchmarks for the roguelike tutorial.')
+    parser.add_argument('--game', default=GAME_FILE, help='chapter file to benchmark')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    dungeon = commands.add_parser('dungeon', help='make_map() + place_objects() across map sizes and room counts')
+    dungeon.add_argument('--generators', default='rooms,caves')
+    dungeon.add_argument('--sizes', default='80x43,200x200,500x500')
+    dungeon.add_argument('--rooms', default='30,300')
+    dungeon.add_argument('--levels', default='1,4,8')
+    dungeon.add_argument('--repeat', type=int, default=20)
+    dungeon.add_argument('--seed', type=int, default=1234)
+    dungeon.add_argument('--output', help='write the results as JSON to this file')
+    dungeon.set_defaults(run=run_dungeon)
+
+    fov = commands.add_parser('fov', help='tcod and NumPy FOV backends for every FOV_ALGO: speed and agreement')
+    fov.add_argument('--generator', default='rooms')
+    fov.add_argument('--sizes', default='80x43,500x500')
+    fov.add_argument('--radii', default='7,20')
+    fov.add_argument('--positions', type=int, default=50)
+    fov.add_argument('--seed', type=int, default=1234)
+    fov.add_argument('--output', help='write the results as JSON to this file')
+    fov.set_defaults(run=run_fov)
+
+    play = commands.add_parser('play', help='the full game loop with scripted keys and no window')
+    play.add_argument('--turns', type=int, default=1000)
+    play.add_argument('--seed', type=int, default=1234)
+    play.add_argument('--output', help='write the results as JSON to this file')
+    play.set_defaults(run=run_play)
+
+    compare = commands.add_parser('compare', help='ratios between two JSON result files (after / before)')
+    compare.add_argument('before')
+    compare.add_argument('after')
+    compare.add_argument('--metrics', default='ms_per_level,peak_memory_bytes,objects_per_level')
+    compare.set_defaults(run=run_compare)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()